@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+"""
+    EarthBound Patcher - An easy-to-use EarthBound ROM patcher.
+    Copyright (C) 2013  Lyrositor <gagne.marc@gmail.com>
+
+    This file is part of EarthBound Patcher.
+
+    EarthBound Patcher is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    EarthBound Patcher is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with EarthBound Patcher.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Batch
+# Creates EBP patches for many hacked ROMs against the same clean ROM.
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+from multiprocessing import shared_memory
+import os
+import sys
+import time
+
+from Diff import *
+from EBPPatch import *
+from ROM import *
+
+# The clean ROM's data, as attached to by each worker process.
+cleanData = None
+
+
+def attachCleanROM(name, size):
+    """Attaches a worker process to the shared clean ROM."""
+
+    global cleanData
+    shared = shared_memory.SharedMemory(name)
+    cleanData = (shared, shared.buf[:size])
+
+
+def createPatchJob(hackedPath, patchPath, metadata, optimize):
+    """Creates the patch for one hacked ROM against the shared clean ROM;
+    returns the amount of ROM data diffed and the time it took."""
+
+    start = time.perf_counter()
+    hackedROM = LazyROM(hackedPath)
+    if not hackedROM.valid:
+        raise ValueError("{} is not a valid ROM.".format(hackedPath))
+
+    target = hackedROM.getvalue()
+    runs = findRuns(cleanData[1], target, padded=optimize)
+    records = makeRecords(runs, target, len(cleanData[1]), optimize)
+    with open(patchPath, "wb") as f:
+        EBPPatch(patchPath, True).writePatch(f, records, target, metadata,
+                                             optimize)
+
+    return len(target), time.perf_counter() - start
+
+
+def jobMetadata(hackedPath, metadata):
+    """Returns the metadata for a hacked ROM: the shared metadata, titled after
+    the ROM, updated from a JSON file next to it if there is one."""
+
+    info = {"patcher": "EBPatcher", "author": "", "description": "",
+            "title": os.path.splitext(os.path.basename(hackedPath))[0]}
+    info.update(metadata or {})
+    try:
+        with open(os.path.splitext(hackedPath)[0] + ".json") as f:
+            info.update(json.load(f))
+    except (IOError, ValueError):
+        pass
+    info["patcher"] = "EBPatcher"
+
+    return json.dumps(info)
+
+
+def createPatches(cleanPath, hackedPaths, outDir, metadata=None, workers=None,
+                  optimize=False):
+    """Creates an EBP patch in the output directory for each hacked ROM. The
+    clean ROM is only loaded once, and is shared with the worker processes.
+    Returns a (hacked ROM, patch, size, seconds, error) tuple for each job, in
+    order, and the total time taken."""
+
+    cleanROM = ROM(cleanPath, repair=True)
+    if not cleanROM.clean:
+        raise ValueError("{} is not a known clean ROM.".format(cleanPath))
+
+    start = time.perf_counter()
+    source = cleanROM.getvalue()
+    shared = shareData(source)
+    try:
+        with ProcessPoolExecutor(workers, initializer=attachCleanROM,
+                                 initargs=(shared.name, len(source))
+                                 ) as executor:
+            jobs = []
+            for hackedPath in hackedPaths:
+                patchPath = os.path.join(outDir, os.path.splitext(
+                            os.path.basename(hackedPath))[0] + ".ebp")
+                jobs.append((hackedPath, patchPath, executor.submit(
+                            createPatchJob, hackedPath, patchPath,
+                            jobMetadata(hackedPath, metadata), optimize)))
+
+            results = []
+            for hackedPath, patchPath, job in jobs:
+                try:
+                    size, seconds = job.result()
+                    results.append((hackedPath, patchPath, size, seconds, None))
+                except Exception as e:
+                    results.append((hackedPath, patchPath, 0, 0, e))
+    finally:
+        shared.close()
+        shared.unlink()
+
+    return results, time.perf_counter() - start
+
+
+########
+# MAIN #
+########
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Creates an EBP patch for "
+                                     "every hacked ROM in a directory.")
+    parser.add_argument("clean", help="the clean EarthBound ROM")
+    parser.add_argument("hacked", help="the directory of hacked ROMs")
+    parser.add_argument("output", help="the directory to write the patches to")
+    parser.add_argument("--author", default="")
+    parser.add_argument("--description", default="")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="the number of processes (default: every CPU)")
+    parser.add_argument("--optimize", action="store_true",
+                        help="make the patches as small as possible")
+    args = parser.parse_args()
+
+    sys.stdout = open(os.devnull, "w")
+    hackedPaths = sorted(os.path.join(args.hacked, f) for f in
+                         os.listdir(args.hacked) if
+                         os.path.splitext(f)[1].lower() in (".smc", ".sfc"))
+    os.makedirs(args.output, exist_ok=True)
+    results, total = createPatches(args.clean, hackedPaths, args.output,
+                                   {"author": args.author,
+                                    "description": args.description},
+                                   args.workers, args.optimize)
+
+    # Report each job, then the overall throughput.
+    failed = 0
+    totalSize = 0
+    for hackedPath, patchPath, size, seconds, error in results:
+        if error:
+            failed += 1
+            sys.stderr.write("FAILED {}: {}\n".format(hackedPath, error))
+        else:
+            totalSize += size
+            sys.stderr.write("{} -> {} in {:.1f} ms\n".format(
+                             hackedPath, patchPath, seconds * 1000))
+    sys.stderr.write("{} patches ({} failed) in {:.2f} s, {:.1f} MB/s\n".format(
+                     len(results), failed, total,
+                     totalSize / 0x100000 / total if total else 0))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+"""
+    EarthBound Patcher - An easy-to-use EarthBound ROM patcher.
+    Copyright (C) 2013  Lyrositor <gagne.marc@gmail.com>
+
+    This file is part of EarthBound Patcher.
+
+    EarthBound Patcher is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    EarthBound Patcher is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with EarthBound Patcher.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# BlockDB
+# Finds where a dump differs from the clean ROM, a block at a time.
+
+import argparse
+from functools import lru_cache
+from hashlib import blake2b
+import os
+import struct
+import sys
+import zlib
+
+# The size of the blocks the ROM is split into.
+REPAIR_BLOCK_SIZE = 0x1000
+
+# The size of each block's hash.
+BLOCK_HASH_SIZE = 16
+
+# Where the clean ROM's block hashes and the repair pack are kept.
+BLOCK_TABLE_PATH = "patches/clean.blocks"
+REPAIR_PACK_PATH = "patches/repair.pack"
+
+# The identification strings of the files.
+TABLE_MAGIC = b"EBBT"
+PACK_MAGIC = b"EBRP"
+
+
+def hashBlocks(data):
+    """Returns the hash of each block of the data, in one pass."""
+
+    return [blake2b(data[i:i + REPAIR_BLOCK_SIZE],
+                    digest_size=BLOCK_HASH_SIZE).digest()
+            for i in range(0, len(data), REPAIR_BLOCK_SIZE)]
+
+
+def writeBlockTable(path, data):
+    """Writes the table of the hashes of the blocks of the clean data."""
+
+    hashes = hashBlocks(data)
+    with open(path, "wb") as f:
+        f.write(TABLE_MAGIC + struct.pack(">II", len(data), len(hashes)))
+        f.write(b"".join(hashes))
+
+
+def fileStamp(path):
+    """Returns the modification time and size of a file, or None if it can't
+    be found."""
+
+    try:
+        s = os.stat(path)
+    except OSError:
+        return None
+    return s.st_mtime_ns, s.st_size
+
+
+def loadBlockTable(path=None):
+    """Returns the size of the clean data and its block hashes, or None if
+    there is no valid table. The table is read again whenever it changes."""
+
+    if path is None:
+        path = BLOCK_TABLE_PATH
+    return readBlockTable(path, fileStamp(path))
+
+
+@lru_cache(maxsize=4)
+def readBlockTable(path, stamp):
+    """Reads a block table, as it was when it had the given stamp."""
+
+    try:
+        with open(path, "rb") as f:
+            d = f.read()
+        assert d[:4] == TABLE_MAGIC
+        size, count = struct.unpack_from(">II", d, 4)
+        hashes = [d[12 + i * BLOCK_HASH_SIZE:12 + (i + 1) * BLOCK_HASH_SIZE]
+                  for i in range(count)]
+        assert len(hashes[-1]) == BLOCK_HASH_SIZE
+        return size, hashes
+    except (IOError, AssertionError, struct.error, IndexError):
+        print("BlockDB.loadBlockTable(): No valid block table.")
+        return None
+
+
+def diffBlocks(data, table):
+    """Returns the indexes of the blocks of the data which differ from those of
+    the clean data described by the table, including the missing ones."""
+
+    size, hashes = table
+    found = hashBlocks(data[:size])
+    return [i for i, h in enumerate(hashes) if i >= len(found) or
+            found[i] != h]
+
+
+def writeRepairPack(path, data, blocks):
+    """Writes a repair pack holding the clean data's blocks."""
+
+    pack = bytearray(PACK_MAGIC)
+    pack += struct.pack(">I", len(blocks))
+    for i in sorted(blocks):
+        start = i * REPAIR_BLOCK_SIZE
+        pack += struct.pack(">I", i) + data[start:start + REPAIR_BLOCK_SIZE]
+    with open(path, "wb") as f:
+        f.write(zlib.compress(pack, 9))
+
+
+def loadRepairPack(path=None):
+    """Returns the {index: data} blocks of a repair pack, or an empty
+    dictionary if there is no valid pack. The pack is read again whenever it
+    changes."""
+
+    if path is None:
+        path = REPAIR_PACK_PATH
+    return readRepairPack(path, fileStamp(path))
+
+
+@lru_cache(maxsize=4)
+def readRepairPack(path, stamp):
+    """Reads a repair pack, as it was when it had the given stamp."""
+
+    try:
+        with open(path, "rb") as f:
+            d = zlib.decompress(f.read())
+        assert d[:4] == PACK_MAGIC
+        count, = struct.unpack_from(">I", d, 4)
+        blocks = {}
+        i = 8
+        for n in range(count):
+            index, = struct.unpack_from(">I", d, i)
+            blocks[index] = d[i + 4:i + 4 + REPAIR_BLOCK_SIZE]
+            i += 4 + REPAIR_BLOCK_SIZE
+        return blocks
+    except (IOError, AssertionError, struct.error, zlib.error):
+        print("BlockDB.loadRepairPack(): No valid repair pack.")
+        return {}
+
+
+def repairPatches(blocks, table, pack):
+    """Returns the (offset, data) clean blocks to write over the data, if the
+    pack has every one of them and they match the table, or None."""
+
+    size, hashes = table
+    for i in blocks:
+        if i not in pack or blake2b(pack[i], digest_size=BLOCK_HASH_SIZE
+                                    ).digest() != hashes[i]:
+            return None
+    return [(i * REPAIR_BLOCK_SIZE, pack[i]) for i in blocks]
+
+
+def repairBlocks(data, blocks, table, pack):
+    """Writes the clean blocks from the pack over the data, which must be as
+    large as the clean data, if the pack has every one of them and they match
+    the table; returns whether or not it did."""
+
+    patches = repairPatches(blocks, table, pack)
+    if patches is None:
+        return False
+    for offset, block in patches:
+        data[offset:offset + len(block)] = block
+    return True
+
+
+########
+# MAIN #
+########
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Builds the block table of "
+                                     "the clean ROM, and a repair pack for "
+                                     "the blocks in which known bad dumps "
+                                     "differ.")
+    parser.add_argument("clean", help="the clean, unheadered EarthBound ROM")
+    parser.add_argument("dumps", nargs="*",
+                        help="unheadered bad dumps to make the pack for")
+    args = parser.parse_args()
+
+    with open(args.clean, "rb") as f:
+        clean = f.read()
+    writeBlockTable(BLOCK_TABLE_PATH, clean)
+    table = loadBlockTable(BLOCK_TABLE_PATH)
+    blocks = set()
+    for dump in args.dumps:
+        with open(dump, "rb") as f:
+            found = diffBlocks(f.read(), table)
+        sys.stderr.write("{}: {} blocks differ\n".format(dump, len(found)))
+        blocks.update(found)
+    if blocks:
+        writeRepairPack(REPAIR_PACK_PATH, clean, blocks)
+        sys.stderr.write("{} blocks in {} ({} bytes)\n".format(len(blocks),
+                         REPAIR_PACK_PATH, os.path.getsize(REPAIR_PACK_PATH)))
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+"""
+    EarthBound Patcher - An easy-to-use EarthBound ROM patcher.
+    Copyright (C) 2013  Lyrositor <gagne.marc@gmail.com>
+
+    This file is part of EarthBound Patcher.
+
+    EarthBound Patcher is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    EarthBound Patcher is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with EarthBound Patcher.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Compatibility
+# Finds which patches of a library write to the same parts of the ROM.
+
+import argparse
+from itertools import combinations
+import json
+import os
+import sys
+import time
+
+from EBPPatch import *
+from PatchAnalysis import *
+
+# The name of the cache of write sets kept in a library.
+CACHE_NAME = ".compatibility.json"
+
+
+def loadWriteSet(patchPath, header=0):
+    """Returns the disjoint (start, end) ranges of the ROM written by a patch,
+    or None if it is not a valid patch. The header only applies to IPS
+    patches, since EBP patches are always unheadered."""
+
+    patch = EBPPatch(patchPath)
+    if not patch.valid or patch.records is None:
+        return None
+    if patch.info is None:
+        patch.header = header
+    return IntervalIndex.fromPatch(patch).merged()
+
+
+def loadWriteSets(patchPaths, cachePath=None, header=0):
+    """Returns the write set of each patch, in order. The write sets are kept
+    in the cache file if one is given, and only recomputed for the patches
+    which changed since."""
+
+    cache = {}
+    if cachePath is not None:
+        try:
+            with open(cachePath) as f:
+                cache = json.load(f)
+        except (IOError, ValueError):
+            pass
+
+    writeSets = []
+    changed = False
+    for patchPath in patchPaths:
+        s = os.stat(patchPath)
+        stamp = [s.st_size, s.st_mtime_ns, header]
+        entry = cache.get(patchPath)
+        if entry is None or entry["stamp"] != stamp:
+            ranges = loadWriteSet(patchPath, header)
+            entry = {"stamp": stamp, "ranges": ranges}
+            cache[patchPath] = entry
+            changed = True
+        ranges = entry["ranges"]
+        writeSets.append(None if ranges is None else
+                         [tuple(r) for r in ranges])
+
+    if cachePath is not None and changed:
+        with open(cachePath + ".tmp", "w") as f:
+            json.dump(cache, f)
+        os.replace(cachePath + ".tmp", cachePath)
+
+    return writeSets
+
+
+def overlapMatrix(writeSets):
+    """Returns the number of bytes written by both patches of every pair that
+    overlaps, as a dictionary indexed by (first patch, second patch). The
+    ranges of every patch are swept through at once, in order."""
+
+    # At the same position, ranges end before others start.
+    events = []
+    for i, ranges in enumerate(writeSets):
+        for start, end in ranges or ():
+            events.append((start, 1, i))
+            events.append((end, 0, i))
+    events.sort()
+
+    overlaps = {}
+    active = []
+    last = 0
+    for position, starting, i in events:
+        if len(active) > 1 and position > last:
+            for pair in combinations(active, 2):
+                overlaps[pair] = overlaps.get(pair, 0) + position - last
+        last = position
+        if starting:
+            active.append(i)
+            active.sort()
+        else:
+            active.remove(i)
+
+    return overlaps
+
+
+########
+# MAIN #
+########
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lists the patches of a "
+                                     "library which can't be combined.")
+    parser.add_argument("library", help="the directory of patches")
+    parser.add_argument("--headered", action="store_true",
+                        help="the IPS patches are for headered ROMs (EBP "
+                        "patches never are)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="don't read or write the cache of write sets")
+    args = parser.parse_args()
+
+    # Keep the standard output for the report.
+    out = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    start = time.perf_counter()
+    patchPaths = sorted(os.path.join(args.library, f) for f in
+                        os.listdir(args.library) if
+                        os.path.splitext(f)[1].lower() in (".ips", ".ebp"))
+    cachePath = None if args.no_cache else os.path.join(args.library,
+                                                         CACHE_NAME)
+    writeSets = loadWriteSets(patchPaths, cachePath,
+                              0x200 if args.headered else 0)
+    overlaps = overlapMatrix(writeSets)
+
+    # Report the invalid patches, then the conflicts, largest first.
+    for patchPath, ranges in zip(patchPaths, writeSets):
+        if ranges is None:
+            out.write("INVALID {}\n".format(patchPath))
+    for (a, b), size in sorted(overlaps.items(), key=lambda o: -o[1]):
+        out.write("{} <-> {}: {} bytes\n".format(patchPaths[a], patchPaths[b],
+                                                 size))
+    out.flush()
+    sys.stderr.write("{} patches, {} conflicting pairs in {:.2f} s\n".format(
+                     len(patchPaths), len(overlaps),
+                     time.perf_counter() - start))
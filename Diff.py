@@ -0,0 +1,318 @@
+"""
+    EarthBound Patcher - An easy-to-use EarthBound ROM patcher.
+    Copyright (C) 2013  Lyrositor <gagne.marc@gmail.com>
+
+    This file is part of EarthBound Patcher.
+
+    EarthBound Patcher is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    EarthBound Patcher is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with EarthBound Patcher.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Diff
+# Finds the differences between two ROMs and turns them into IPS records.
+
+import re
+
+# The amount of data compared at once (one HiROM bank).
+BLOCK_SIZE = 0x10000
+
+# The largest size an IPS record can have, since it is stored in 2 bytes.
+MAX_RECORD_SIZE = 0xFFFF
+
+# The offset which would be mistaken for the end of the patch.
+EOF_OFFSET = int.from_bytes(b"EOF", "big")
+
+# The size of a record's offset and size fields.
+RECORD_HEADER_SIZE = 5
+
+# The total size of an RLE record.
+RLE_RECORD_SIZE = 8
+
+# The amount of a run searched at once for repeated bytes.
+ENCODE_SIZE = 0x10 * BLOCK_SIZE
+
+# The shared ROM data attached to by each worker process.
+sharedROMs = None
+
+# Matches the differing bytes in the XOR of two blocks.
+NONZERO = re.compile(b"[^\x00]+")
+
+# Matches a byte repeated enough times to be worth an RLE record.
+REPEATED = re.compile(b"(.)\\1{%d,}" % RLE_RECORD_SIZE, re.DOTALL)
+
+
+class PatchCancelled(Exception):
+    """Raised when the creation of a patch is cancelled."""
+
+
+def addRun(runs, start, end):
+    """Appends a run to the list, merging it with the last one if they touch."""
+
+    if runs and runs[-1][1] == start:
+        runs[-1] = (runs[-1][0], end)
+    else:
+        runs.append((start, end))
+
+
+def findRuns(source, target, start=0, end=None, progress=None, cancel=None,
+             padded=False):
+    """Returns the (start, end) ranges in which the target differs from the
+    source. Any part of the target past the end of the source differs, unless
+    padded is set, in which case it is compared to the zeros the ROM is padded
+    with when it is expanded.
+
+    progress is called with the number of bytes scanned so far and the total
+    after each block, and the diff stops with PatchCancelled as soon as the
+    cancel event (e.g. a threading.Event) is set."""
+
+    if end is None or end > len(target):
+        end = len(target)
+    sourceEnd = min(end, len(source))
+
+    runs = []
+    for a in range(start, sourceEnd, BLOCK_SIZE):
+        if cancel is not None and cancel.is_set():
+            raise PatchCancelled()
+        if progress is not None:
+            progress(a - start, end - start)
+        b = min(a + BLOCK_SIZE, sourceEnd)
+        s = bytes(source[a:b])
+        t = bytes(target[a:b])
+        if s == t:
+            continue
+
+        # XOR the blocks as big integers; the differing bytes are non-zero.
+        x = int.from_bytes(s, "big") ^ int.from_bytes(t, "big")
+        for m in NONZERO.finditer(x.to_bytes(b - a, "big")):
+            addRun(runs, a + m.start(), a + m.end())
+
+    if padded:
+        for a in range(max(start, sourceEnd), end, BLOCK_SIZE):
+            if cancel is not None and cancel.is_set():
+                raise PatchCancelled()
+            for m in NONZERO.finditer(bytes(target[a:min(a + BLOCK_SIZE,
+                                                         end)])):
+                addRun(runs, a + m.start(), a + m.end())
+    elif end > max(start, sourceEnd):
+        addRun(runs, max(start, sourceEnd), end)
+    if progress is not None:
+        progress(max(end - start, 0), max(end - start, 0))
+
+    return runs
+
+
+def findRunsParallel(source, target, workers=None, progress=None,
+                     cancel=None, padded=False):
+    """Finds the same runs as findRuns, diffing each bank in a separate worker
+    process; both ROMs are shared with the workers instead of being copied."""
+
+    # Only imported when needed, as it is slow to import.
+    from concurrent.futures import ProcessPoolExecutor
+
+    sharedSource = shareData(source)
+    sharedTarget = shareData(target)
+    try:
+        banks = range(0, len(target), BLOCK_SIZE)
+        with ProcessPoolExecutor(workers, initializer=attachROMs,
+                                 initargs=(sharedSource.name, len(source),
+                                           sharedTarget.name, len(target),
+                                           padded)
+                                 ) as executor:
+            # The banks come back in order, so the result is the same no matter
+            # how many workers there are.
+            runs = []
+            for i, bankRuns in enumerate(executor.map(diffBank, banks,
+                                                      chunksize=4)):
+                if cancel is not None and cancel.is_set():
+                    executor.shutdown(cancel_futures=True)
+                    raise PatchCancelled()
+                if progress is not None:
+                    progress(min((i + 1) * BLOCK_SIZE, len(target)),
+                             len(target))
+                for start, end in bankRuns:
+                    addRun(runs, start, end)
+    finally:
+        for shared in (sharedSource, sharedTarget):
+            shared.close()
+            shared.unlink()
+
+    return runs
+
+
+def shareData(data):
+    """Copies the data into a new block of shared memory."""
+
+    from multiprocessing import shared_memory
+    shared = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+    shared.buf[:len(data)] = data
+    return shared
+
+
+def attachROMs(sourceName, sourceSize, targetName, targetSize, padded):
+    """Attaches a worker process to the shared ROM data."""
+
+    from multiprocessing import shared_memory
+    global sharedROMs
+    source = shared_memory.SharedMemory(sourceName)
+    target = shared_memory.SharedMemory(targetName)
+    sharedROMs = (source, target, source.buf[:sourceSize],
+                  target.buf[:targetSize], padded)
+
+
+def diffBank(start):
+    """Finds the runs inside the bank starting at the given offset."""
+
+    return findRuns(sharedROMs[2], sharedROMs[3], start, start + BLOCK_SIZE,
+                    padded=sharedROMs[4])
+
+
+def makeRecords(runs, target, sourceSize, optimize=False):
+    """Turns the runs into records, encoded as compactly as possible if
+    optimize is set. Optimized runs are expected to come from a padded diff,
+    so the last byte of a larger target is always written, which lets patchers
+    that don't read the target size still expand the ROM to it."""
+
+    if not optimize:
+        return splitRuns(runs)
+
+    size = len(target)
+    if size > sourceSize and (not runs or runs[-1][1] < size):
+        runs = runs + [(size - 1, size)]
+    return encodeRuns(runs, target)
+
+
+def splitRuns(runs):
+    """Splits the runs into (offset, size, value) literal records that fit in
+    an IPS patch."""
+
+    records = []
+    for start, end in runs:
+        addRecord(records, start, end - start, None)
+
+    return records
+
+
+def encodeRuns(runs, target):
+    """Encodes the runs into the smallest set of (offset, size, value) records,
+    using RLE records for repeated bytes and merging literal records across
+    gaps shorter than a record header."""
+
+    # Split each run into literal and RLE pieces.
+    pieces = []
+    for start, end in runs:
+        for piece in encodeRun(target, start, end):
+            offset, size, value = piece
+            if pieces:
+                last = pieces[-1]
+                gap = offset - last[0] - last[1]
+
+                # Merge pieces of the same kind which touch, and literals when
+                # rewriting the unchanged bytes between them costs no more
+                # than the header of a new record.
+                if gap == 0 and value == last[2] or \
+                   value is None and last[2] is None and \
+                   gap <= RECORD_HEADER_SIZE and \
+                   offset + size - last[0] <= MAX_RECORD_SIZE:
+                    pieces[-1] = (last[0], offset + size - last[0], value)
+                    continue
+            pieces.append(piece)
+
+    records = []
+    for offset, size, value in pieces:
+        addRecord(records, offset, size, value, target)
+
+    return records
+
+
+def encodeRun(target, start, end):
+    """Splits a single run into literal and RLE pieces, looking at a limited
+    amount of it at a time."""
+
+    pieces = []
+    for a in range(start, end, ENCODE_SIZE):
+        b = min(a + ENCODE_SIZE, end)
+        pieces += encodeChunk(bytes(target[a:b]), a)
+
+    return pieces
+
+
+def encodeChunk(data, start):
+    """Splits a chunk of a run into literal and RLE pieces."""
+
+    size = len(data)
+
+    # A run made of a single byte repeated is cheaper as RLE past 3 bytes.
+    if size > RLE_RECORD_SIZE - RECORD_HEADER_SIZE and \
+       data.count(data[:1]) == size:
+        return [(start, size, data[0])]
+
+    pieces = []
+    i = 0
+    for m in REPEATED.finditer(data):
+        a, b = m.span()
+        # A repeated sequence in the middle of a run costs a new literal
+        # header on top of the RLE record; at either end it doesn't.
+        threshold = RLE_RECORD_SIZE
+        if a > 0 and b < size:
+            threshold += RECORD_HEADER_SIZE
+        if b - a <= threshold:
+            continue
+        if a > i:
+            pieces.append((start + i, a - i, None))
+        pieces.append((start + a, b - a, data[a]))
+        i = b
+    if i < size:
+        pieces.append((start + i, size - i, None))
+
+    return pieces
+
+
+def addRecord(records, offset, size, value, target=None):
+    """Appends a record, splitting it so that every part fits in 2 bytes and
+    none of them starts at the EOF offset."""
+
+    end = offset + size
+    while offset < end:
+        size = min(end - offset, MAX_RECORD_SIZE)
+        if offset == EOF_OFFSET:
+            # Go back one byte to work around this IPS limitation. An RLE
+            # record can only do so if the previous byte is the same.
+            # Otherwise, its first byte goes into a literal record instead.
+            if value is None or target[offset - 1] == value:
+                offset -= 1
+                size = min(end - offset, MAX_RECORD_SIZE)
+            else:
+                last = records[-1] if records else None
+                if last and last[2] is None and \
+                   last[0] + last[1] == offset and last[1] < MAX_RECORD_SIZE:
+                    records[-1] = (last[0], last[1] + 1, None)
+                else:
+                    records.append((offset - 1, 2, None))
+                offset += 1
+                continue
+        records.append((offset, size, value))
+        offset += size
+
+
+def writeRecords(out, records, target):
+    """Writes the records' headers and their data from the target."""
+
+    for offset, size, value in records:
+        out.write(offset.to_bytes(3, "big"))
+        if value is None:
+            out.write(size.to_bytes(2, "big"))
+            out.write(target[offset:offset + size])
+        else:
+            out.write(b"\x00\x00")
+            out.write(size.to_bytes(2, "big"))
+            out.write(bytes((value,)))
@@ -21,20 +21,27 @@
 # EBPPatch
 # Handles the import of EBP (EarthBound Patch) patches.
 
+import base64
+from io import BytesIO
 import json
 
+from Diff import *
 from IPSPatch import *
+from PatchStack import *
+from ROM import *
 
 
 class EBPPatch(IPSPatch):
     """The new EarthBound patcher format for patching, based on IPS."""
 
-    def __init__(self, patchPath, new=False):
+    def __init__(self, patchPath, new=False, data=None):
         """Creates a new patch or loads an existing one."""
 
-        super().__init__(patchPath, new)
+        super().__init__(patchPath, new, data)
         if not new:
             self.info = self.loadMetadata()
+            if self.info and "size" in self.info:
+                self.size = self.info["size"]
         else:
             self.patchPath = patchPath
 
@@ -54,49 +61,123 @@ class EBPPatch(IPSPatch):
 
         return info
 
-    def createFromSource(self, sourceROM, targetROM, metadata):
-        """Creates an EBP patch from the source and target ROMs."""
-
-        # Create the records.
-        i = None
-        records = {}
-        sourceROM.seek(0)
-        targetROM.seek(0)
-        s = sourceROM.read(1)
-        t = targetROM.read(1)
-        while t:
-            if t == s and i is not None:
-                i = None
-            elif t != s:
-                if i is not None:
-                    # Check that the record's size can fit in 2 bytes.
-                    if targetROM.tell() - 1 - i == 0xFFFF:
-                        i = None
-                        continue
-                    records[i] += t
-                else:
-                    i = targetROM.tell() - 1
-                    # Check that the offset isn't EOF. If it is, go back one
-                    # byte to work around this IPS limitation.
-                    if i.to_bytes(3, "big") != b"EOF":
-                        records[i] = t
-                    else:
-                        i -= 1
-                        records[i] = targetROM.getvalue()[i]
-            s = sourceROM.read(1)
-            t = targetROM.read(1)
+    def createFromSource(self, sourceROM, targetROM, metadata, optimize=False,
+                         workers=1, progress=None, cancel=None,
+                         reversible=False):
+        """Creates an EBP patch from the source and target ROMs. If optimize is
+        set, the records are encoded to make the patch as small as possible.
+        With more than one worker, the ROMs are diffed in parallel processes
+        (None uses every CPU). progress and cancel are passed on to findRuns;
+        nothing is written if the creation is cancelled.
+
+        Optimized patches also skip the zeros of an expanded target, and store
+        its size in the metadata. Reversible patches also store the source's
+        bytes under every record, so that they can be undone."""
+
+        # Find where the ROMs differ and turn it into records.
+        source = sourceROM.getvalue()
+        target = targetROM.getvalue()
+        if workers == 1:
+            runs = findRuns(source, target, 0, None, progress, cancel,
+                            optimize)
+        else:
+            runs = findRunsParallel(source, target, workers, progress, cancel,
+                                    optimize)
+        records = makeRecords(runs, target, len(source), optimize)
 
         # Write the patch.
         self.seek(0)
-        self.write(b"PATCH")
-        for r in sorted(records):
-            self.write(r.to_bytes(3, "big"))
-            self.write(len(records[r]).to_bytes(2, "big"))
-            self.write(records[r])
-        self.write(b"EOF")
-        self.write(bytes(metadata, "utf-8"))
+        self.writePatch(self, records, target, metadata, optimize,
+                        source if reversible else None)
 
         # Write the patch to a file.
         f = open(self.patchPath, "wb")
         f.write(self.getvalue())
         f.close()
+
+    def createFromFiles(self, sourcePath, targetPath, metadata,
+                        sourceLayout=None, targetLayout=None, optimize=False,
+                        progress=None, cancel=None, reversible=False):
+        """Creates an EBP patch straight from the source and target ROM files,
+        reading them a window at a time; the layouts describe how to normalize
+        each file, and are detected if they are not given."""
+
+        with ROMFile(sourcePath, sourceLayout, True) as source, \
+             ROMFile(targetPath, targetLayout) as target:
+            runs = findRuns(source, target, 0, None, progress, cancel,
+                            optimize)
+            records = makeRecords(runs, target, len(source), optimize)
+
+            with open(self.patchPath, "wb") as f:
+                self.writePatch(f, records, target, metadata, optimize,
+                                source if reversible else None)
+
+    def writePatch(self, f, records, target, metadata, withSize=False,
+                   source=None):
+        """Writes the records, taking their data from the target, and the
+        metadata to the file. withSize adds the target's size to the metadata,
+        so that the ROM can be resized to it in one go. If the source is given,
+        the patch which undoes this one is added to the metadata."""
+
+        if withSize or source is not None:
+            info = json.loads(metadata)
+            if withSize:
+                info["size"] = len(target)
+            if source is not None:
+                info["undo"] = base64.b64encode(makeUndo(records,
+                               source, len(target))).decode("ascii")
+            metadata = json.dumps(info)
+
+        f.write(b"PATCH")
+        writeRecords(f, records, target)
+        f.write(b"EOF")
+        f.write(bytes(metadata, "utf-8"))
+
+    @staticmethod
+    def streamSize(tail):
+        """Returns the size stored in a streamed patch's metadata, if any."""
+
+        try:
+            info = json.loads(tail.decode("utf-8"))
+            if info["patcher"] == "EBPatcher":
+                return info.get("size")
+        except (ValueError, KeyError, TypeError):
+            pass
+        return IPSPatch.streamSize(tail)
+
+    def undoPatch(self):
+        """Returns the IPS patch which turns a ROM patched with this patch back
+        into the source ROM, or None if this patch is not reversible."""
+
+        if not self.info or "undo" not in self.info:
+            return None
+        return IPSPatch(None, data=base64.b64decode(self.info["undo"]))
+
+    def switchPatch(self, other):
+        """Returns a single patch which turns a ROM patched with this patch
+        into the same ROM patched with the other one instead."""
+
+        undo = self.undoPatch()
+        if undo is None:
+            raise ValueError("The patch is not reversible.")
+        return PatchStack([undo, other]).flatten()
+
+
+def makeUndo(records, source, targetSize):
+    """Returns an IPS patch writing back the source's bytes under each record,
+    and past the end of a smaller target, and restoring the source's size."""
+
+    runs = []
+    for offset, size, value in records:
+        end = min(offset + size, len(source), targetSize)
+        if offset < end:
+            addRun(runs, offset, end)
+    if targetSize < len(source):
+        addRun(runs, targetSize, len(source))
+
+    f = BytesIO()
+    f.write(b"PATCH")
+    writeRecords(f, splitRuns(runs), source)
+    f.write(b"EOF")
+    f.write(len(source).to_bytes(3, "big"))
+    return f.getvalue()
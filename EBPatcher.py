@@ -24,9 +24,11 @@
 # An easy-to-use EarthBound ROM patcher.
 
 import array
+from collections import OrderedDict
 import os
 import re
 import sys
+import threading
 
 from PyQt5 import QtCore, QtGui, QtWidgets
 import res
@@ -42,6 +44,15 @@ VERSION = 1.0
 # The hack repository website.
 WEBSITE = "http://hacks.lyros.net/"
 
+# The field the patch to apply is typed in, after the three ROM fields.
+PATCH_FIELD = 4
+
+# How long to wait after a path is typed before loading it, in milliseconds.
+DEBOUNCE_TIME = 300
+
+# The number of loaded ROMs and patches kept, in case they are selected again.
+LOADED_CACHE_SIZE = 8
+
 def cap(s, l):
     """Caps a string to a certain length and appends "..." afterwards.
     Source: http://stackoverflow.com/questions/11602386/#11602405"""
@@ -57,11 +68,88 @@ class AboutDialog(QtWidgets.QDialog, About.Ui_Dialog):
     """The about dialog for EBPatcher."""
 
 
+def loadFile(field, path):
+    """Loads and checks the ROM or patch of a field, in a background thread."""
+
+    try:
+        if field == PATCH_FIELD:
+            if os.path.splitext(path)[1].lower() == ".ebp":
+                return EBPPatch(path)
+            return IPSPatch(path)
+
+        # Check the ROM now, instead of when the GUI first asks. Only the clean
+        # ROM is repaired, since a hacked ROM's changes could look like damage.
+        rom = LazyROM(path, field == 2)
+        rom.clean
+        return rom
+    except (IOError, ValueError):
+        return None
+
+
+class LoaderSignals(QtCore.QObject):
+    """The signals of a Loader, which can't have any itself."""
+
+    loaded = QtCore.pyqtSignal(int, str, object, object)
+
+
+class Loader(QtCore.QRunnable):
+    """Loads a ROM or a patch in the thread pool."""
+
+    def __init__(self, field, path, key):
+        """Prepares to load the file of a field."""
+
+        QtCore.QRunnable.__init__(self)
+        self.field = field
+        self.path = path
+        self.key = key
+        self.signals = LoaderSignals()
+
+    def run(self):
+        """Loads the file, then hands it over."""
+
+        self.signals.loaded.emit(self.field, self.path, self.key,
+                                 loadFile(self.field, self.path))
+
+
+class PatchCreator(QtCore.QThread):
+    """Creates an EBP patch in its own thread, reporting its progress."""
+
+    progressed = QtCore.pyqtSignal(int, int)
+    done = QtCore.pyqtSignal(str)
+
+    def __init__(self, patch, cleanROM, hackedROM, metadata):
+        """Prepares the patch's creation."""
+
+        QtCore.QThread.__init__(self)
+        self.patch = patch
+        self.cleanROM = cleanROM
+        self.hackedROM = hackedROM
+        self.metadata = metadata
+        self.cancelEvent = threading.Event()
+
+    def run(self):
+        """Creates the patch, then reports how it went."""
+
+        try:
+            self.patch.createFromSource(self.cleanROM, self.hackedROM,
+                                        self.metadata,
+                                        progress=self.progressed.emit,
+                                        cancel=self.cancelEvent)
+        except PatchCancelled:
+            self.done.emit("cancelled")
+        except:
+            self.done.emit("error")
+        else:
+            self.done.emit("success")
+
+    def cancel(self):
+        """Asks for the patch's creation to stop."""
+
+        self.cancelEvent.set()
+
+
 class EBPatcher(QtWidgets.QApplication):
     """The Qt application used for EBPatcher."""
-    # Create signal as it was not automatically inherited from QApplication like in pyQT4 < 4.15
-    #https://www.riverbankcomputing.com/static/Docs/PyQt4/new_style_signals_slots.html
-    runPatch = QtCore.pyqtSignal()
 
     def __init__(self, args):
         """Initializes the application and opens the main window."""
@@ -72,8 +160,19 @@ class EBPatcher(QtWidgets.QApplication):
         self.createPatch = None
         self.createCleanROM = None
         self.createHackedROM = None
+        self.creator = None
+        self.progress = None
         self.currentPath = ""
 
+        # The files being loaded in the background, the ones already loaded
+        # (by identity) and the timers waiting for typing to stop.
+        self.pool = QtCore.QThreadPool()
+        self.loaders = set()
+        self.requested = {}
+        self.keys = {}
+        self.loaded = OrderedDict()
+        self.timers = {}
+
         # Load the main window.
         QtWidgets.QApplication.__init__(self, args)
         self.main = MainWindow()
@@ -93,10 +192,11 @@ class EBPatcher(QtWidgets.QApplication):
         self.main.ApplyStep1Button.clicked.connect(lambda button=1:
                                                    self.selectROM(1))
         self.main.ApplyStep1Field.textChanged.connect(lambda romPath:
-                                                      self.checkROM(romPath, 1))
+                                                  self.scheduleLoad(1, romPath))
         self.main.ApplyStep2Button.clicked.connect(lambda button=1:
                                                    self.selectPatch(1))
-        self.main.ApplyStep2Field.textChanged.connect(self.checkPatch)
+        self.main.ApplyStep2Field.textChanged.connect(lambda patchPath:
+                                       self.scheduleLoad(PATCH_FIELD, patchPath))
         self.main.ApplyStep2Headered.toggled.connect(self.setHeadered)
         self.main.ApplyStep2Unheadered.toggled.connect(self.setUnheadered)
         self.main.ApplyPatchButton.clicked.connect(self.applyPatchToROM)
@@ -105,13 +205,12 @@ class EBPatcher(QtWidgets.QApplication):
         self.main.CreateStep1HackedButton.clicked.connect(lambda button=3:
                                                          self.selectROM(3))
         self.main.CreateStep1CleanField.textChanged.connect(lambda romPath:
-                                                      self.checkROM(romPath, 2))
+                                                  self.scheduleLoad(2, romPath))
         self.main.CreateStep1HackedField.textChanged.connect(lambda romPath:
-                                                      self.checkROM(romPath, 3))
+                                                  self.scheduleLoad(3, romPath))
         self.main.CreateStep2Button.clicked.connect(lambda button=2:
                                                     self.selectPatch(2))
         self.main.CreatePatchButton.clicked.connect(self.createPatchFromROMs)
-        self.runPatch.connect(self.startCreatingPatch, QtCore.Qt.QueuedConnection)
 
     def openAboutDialog(self):
         """Opens the "About" dialog window."""
@@ -181,17 +280,97 @@ class EBPatcher(QtWidgets.QApplication):
             # Has the Apply Patch browse button been pressed?
             if button == 1:
                 self.resetApplyStep(1)
-                self.applyROM = ROM(romPath[0])
+                self.requestLoad(1, romPath[0])
                 self.main.ApplyStep1Field.setText(romPath[0])
             # Has the Clean ROM browse button been pressed?
             elif button == 2:
-                self.createCleanROM = ROM(romPath[0])
+                self.requestLoad(2, romPath[0])
                 self.main.CreateStep1CleanField.setText(romPath[0])
             # Has the Hacked ROM browse button been pressed?
             elif button == 3:
-                self.createHackedROM = ROM(romPath[0])
+                self.requestLoad(3, romPath[0])
                 self.main.CreateStep1HackedField.setText(romPath[0])
 
+    def scheduleLoad(self, field, path):
+        """Loads the file typed in a field once the typing stops."""
+
+        if path == self.requested.get(field):
+            return
+        if field not in self.timers:
+            timer = QtCore.QTimer()
+            timer.setSingleShot(True)
+            timer.setInterval(DEBOUNCE_TIME)
+            timer.timeout.connect(lambda field=field: self.requestLoad(field,
+                                  self.timers[field][1]))
+            self.timers[field] = [timer, path]
+        self.timers[field][1] = path
+        self.timers[field][0].start()
+
+    def requestLoad(self, field, path):
+        """Loads the ROM or patch of a field in the background, unless the same
+        file was already loaded."""
+
+        if field in self.timers:
+            self.timers[field][0].stop()
+        self.requested[field] = path
+        try:
+            key = fileIdentity(path) + (field == 2,)
+        except OSError:
+            return
+        if not os.path.isfile(path):
+            return
+
+        if key in self.loaded:
+            self.loaded.move_to_end(key)
+            self.finishLoading(field, path, key, self.loaded[key])
+            return
+
+        self.main.setCursor(QtCore.Qt.BusyCursor)
+        loader = Loader(field, path, key)
+        loader.signals.loaded.connect(self.finishLoading)
+        self.loaders.add(loader)
+        self.pool.start(loader)
+
+    def finishLoading(self, field, path, key, loaded):
+        """Uses a loaded ROM or patch, if it is still the one wanted."""
+
+        for loader in list(self.loaders):
+            if loader.field == field and loader.path == path:
+                self.loaders.discard(loader)
+        if not self.loaders:
+            self.main.setCursor(QtCore.Qt.ArrowCursor)
+        if self.requested.get(field) != path:
+            return
+
+        if loaded is None:
+            QtWidgets.QMessageBox.critical(self.main, "Error",
+                                           "The file could not be opened.")
+            return
+        self.loaded[key] = loaded
+        while len(self.loaded) > LOADED_CACHE_SIZE:
+            self.loaded.popitem(False)
+        self.keys[field] = key
+
+        # Each field gets its own ROM, since applying a patch modifies it.
+        roms = {1: self.applyROM, 2: self.createCleanROM,
+                3: self.createHackedROM}
+        if field in roms and loaded.valid and \
+           any(rom is loaded for f, rom in roms.items() if f != field):
+            loaded = loaded.copy()
+
+        # Check the ROM or patch like when it is selected.
+        if field == 1:
+            self.applyROM = loaded
+        elif field == 2:
+            self.createCleanROM = loaded
+        elif field == 3:
+            self.createHackedROM = loaded
+        else:
+            self.applyPatch = loaded
+            self.checkPatch(path)
+            return
+        self.checkROM(path, field)
+
     def checkROM(self, romPath, field):
         """Check the validity of the specified ROM."""
 
@@ -268,10 +447,7 @@ class EBPatcher(QtWidgets.QApplication):
             if patchPath:
                 self.currentPath = os.path.dirname(patchPath[0])
                 self.resetApplyStep(2)
-                if os.path.splitext(patchPath[0])[1] == ".ebp":
-                    self.applyPatch = EBPPatch(patchPath[0])
-                else:
-                    self.applyPatch = IPSPatch(patchPath[0])
+                self.requestLoad(PATCH_FIELD, patchPath[0])
                 self.main.ApplyStep2Field.setText(patchPath[0])
 
         # Has the button from the Create Patch screen been pressed?
@@ -361,6 +537,9 @@ class EBPatcher(QtWidgets.QApplication):
     def applyPatchToROM(self):
         """Apply the selected patch to the selected ROM."""
 
+        # The ROM is about to be modified, so it can't be reused as it is.
+        self.loaded.pop(self.keys.get(1), None)
+
         try:
             self.main.setCursor(QtCore.Qt.WaitCursor)
             self.applyPatch.applyToTarget(self.applyROM)
@@ -382,11 +561,6 @@ class EBPatcher(QtWidgets.QApplication):
         self.main.CreateStep1.setDisabled(True)
         self.main.CreateStep2.setDisabled(True)
         self.main.CreatePatchButton.setDisabled(True)
-        self.main.setCursor(QtCore.Qt.WaitCursor)
-        self.runPatch.emit()
-
-    def startCreatingPatch(self):
-        """Starts creating the patch in its own thread."""
 
         # Prepare the metadata.
         author = self.main.CreateStep2PatchAuthor.text()
@@ -395,21 +569,49 @@ class EBPatcher(QtWidgets.QApplication):
         metadata = json.dumps({"patcher": "EBPatcher", "author": author,
                                "title": title, "description": description})
 
-        # Try to create the patch; if it fails, display an error message.
-        try:
-            self.createPatch.createFromSource(self.createCleanROM,
-                                              self.createHackedROM, metadata)
-        except:
-            QtWidgets.QMessageBox.critical(self.main, "Error",
+        # Show the progress, letting the user cancel the creation.
+        self.progress = QtWidgets.QProgressDialog("Creating the patch...",
+                                                  "Cancel", 0, 100, self.main)
+        self.progress.setWindowTitle("Create Patch")
+        self.progress.setWindowModality(QtCore.Qt.WindowModal)
+        self.progress.setAutoReset(False)
+        self.progress.setMinimumDuration(0)
+        self.progress.setValue(0)
+
+        # Create the patch in its own thread.
+        self.creator = PatchCreator(self.createPatch, self.createCleanROM,
+                                    self.createHackedROM, metadata)
+        self.creator.progressed.connect(self.updateProgress)
+        self.creator.done.connect(self.finishCreatingPatch)
+        self.progress.canceled.connect(self.creator.cancel)
+        self.creator.start()
+
+    def updateProgress(self, scanned, total):
+        """Shows how much of the ROMs has been scanned."""
+
+        if self.progress and total:
+            self.progress.setValue(scanned * 100 // total)
+
+    def finishCreatingPatch(self, result):
+        """Restores the window once the patch's creation is over."""
+
+        self.creator.wait()
+        self.creator = None
+        self.progress.canceled.disconnect()
+        self.progress.reset()
+        self.progress = None
+
+        # If it failed or was cancelled, let the user try again.
+        if result != "success":
+            if result == "error":
+                QtWidgets.QMessageBox.critical(self.main, "Error",
                                        "There was an error creating the patch.")
             self.main.CreateStep1.setEnabled(True)
             self.main.CreateStep2.setEnabled(True)
             self.main.CreatePatchButton.setEnabled(True)
-            self.main.setCursor(QtCore.Qt.ArrowCursor)
             return
 
         # Restore the window to its original setting, display a success message.
-        self.main.setCursor(QtCore.Qt.ArrowCursor)
         self.resetCreateStep(2)
         self.resetCreateStep(1)
         QtWidgets.QMessageBox.information(self.main, "Success",
@@ -428,6 +630,10 @@ if __name__ == "__main__":
     else:
         sys.stdout = open(os.devnull, "w")
         sys.stderr = open(os.devnull, "w")
+    try:
+        ROM.cache = IdentityCache()
+    except (OSError, sqlite3.Error):
+        print("Could not open the identification cache.")
     a = EBPatcher(sys.argv)
     exit = a.exec_()
     sys.stdout = stdout
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+
+"""
+    EarthBound Patcher - An easy-to-use EarthBound ROM patcher.
+    Copyright (C) 2013  Lyrositor <gagne.marc@gmail.com>
+
+    This file is part of EarthBound Patcher.
+
+    EarthBound Patcher is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    EarthBound Patcher is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with EarthBound Patcher.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# EBPatcherCLI
+# Applies, creates and checks patches from the command line, without the GUI.
+# The patching modules are only imported by the commands which use them, so
+# that the script starts quickly.
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+# The path standing for the standard input or output.
+STDIO = "-"
+
+
+def openInput(path):
+    """Opens a file, or the standard input, as a binary stream."""
+
+    if path == STDIO:
+        return open(sys.stdin.fileno(), "rb", closefd=False)
+    return open(path, "rb")
+
+
+def loadPatch(patchPath, header=0):
+    """Loads an EBP or IPS patch from a file or the standard input."""
+
+    from EBPPatch import EBPPatch
+
+    with openInput(patchPath) as f:
+        patch = EBPPatch(None, data=f.read())
+    if not patch.valid or patch.records is None:
+        raise ValueError("{} is not a valid patch.".format(patchPath))
+    patch.header = header
+
+    return patch
+
+
+def useCache(args):
+    """Makes ROMs remember what they were identified as, unless told not to."""
+
+    from IdentityCache import IdentityCache
+    from ROM import ROM
+
+    if not args.no_cache:
+        try:
+            ROM.cache = IdentityCache()
+        except Exception:
+            print("EBPatcherCLI.useCache(): Could not open the cache.")
+
+
+def applyCommand(args, out):
+    """Applies a patch to a ROM the way the GUI does: to its data as loaded,
+    without its unused expanded space and repaired if it can be. A ROM which
+    didn't need fixing keeps its header, and only the bytes the patch changes
+    are written."""
+
+    from ROM import ROM
+
+    if args.patch == STDIO and args.rom == STDIO:
+        raise ValueError("The patch and the ROM can't both be read from the "
+                         "standard input.")
+    patch = loadPatch(args.patch, 0x200 if args.headered else 0)
+
+    # A ROM read from or written to a pipe goes through a temporary file.
+    # Otherwise, the ROM is patched in place unless an output is given.
+    with tempfile.TemporaryDirectory() as directory:
+        romPath = args.rom
+        if args.rom == STDIO:
+            romPath = os.path.join(directory, "rom")
+            with openInput(STDIO) as f, open(romPath, "wb") as rom:
+                shutil.copyfileobj(f, rom)
+        else:
+            useCache(args)
+        outPath = args.output or args.rom
+        if outPath == STDIO:
+            outPath = os.path.join(directory, "patched")
+
+        ROM(romPath).writePatched(patch, outPath)
+
+        if (args.output or args.rom) == STDIO:
+            out.flush()
+            with open(outPath, "rb") as f:
+                shutil.copyfileobj(f, out.buffer)
+
+    return 0
+
+
+def createCommand(args, out):
+    """Creates an EBP patch from a clean ROM and a hacked ROM."""
+
+    from Diff import findRuns, makeRecords
+    from EBPPatch import EBPPatch
+    from ROM import LazyROM, ROMFile
+
+    # A patch of any other ROM wouldn't apply to clean ROMs.
+    useCache(args)
+    if not LazyROM(args.clean, True).clean:
+        raise ValueError("{} is not a known clean ROM.".format(args.clean))
+
+    metadata = json.dumps({"patcher": "EBPatcher", "title": args.title,
+                           "author": args.author,
+                           "description": args.description})
+    with ROMFile(args.clean, repair=True) as source, \
+         ROMFile(args.hacked) as target:
+        runs = findRuns(source, target, padded=args.optimize)
+        records = makeRecords(runs, target, len(source), args.optimize)
+        out.flush()
+        f = out.buffer if args.output == STDIO else open(args.output, "wb")
+        try:
+            EBPPatch(None, True).writePatch(f, records, target, metadata,
+                                            args.optimize, source if
+                                            args.reversible else None)
+        finally:
+            if f is not out.buffer:
+                f.close()
+
+    return 0
+
+
+def verifyCommand(args, out):
+    """Checks that a ROM is (or can be repaired to) a clean ROM, and that the
+    patch, if any, can be applied to it safely."""
+
+    from PatchAnalysis import analyzePatch
+    from ROM import LazyROM
+
+    useCache(args)
+    rom = LazyROM(args.rom)
+    ok = rom.clean
+    if not ok:
+        sys.stderr.write("{} is not a clean EarthBound ROM.\n".format(
+                         args.rom))
+
+    if args.patch:
+        patch = loadPatch(args.patch, 0x200 if args.headered else 0)
+        report = analyzePatch(patch, rom.seek(0, 2) if rom.valid else rom.size)
+        if not report.valid():
+            sys.stderr.write("".join(line + "\n" for line in
+                                     report.describe()))
+            ok = False
+
+    return 0 if ok else 1
+
+
+def infoCommand(args, out):
+    """Describes a patch: its metadata and what it writes."""
+
+    from PatchAnalysis import analyzePatch
+
+    patch = loadPatch(args.patch, 0x200 if args.headered else 0)
+    info = getattr(patch, "info", None) or {}
+    lines = ["Format: {}".format("EBP" if info else "IPS")]
+    for key in ("title", "author", "description"):
+        if info.get(key):
+            lines.append("{}: {}".format(key.capitalize(), info[key]))
+    lines.append("Reversible: {}".format("yes" if "undo" in info else "no"))
+    lines += analyzePatch(patch).describe()
+    out.write("".join(line + "\n" for line in lines))
+
+    return 0
+
+
+def identifyCommand(args, out):
+    """Reports whether each ROM is a clean, unclean or invalid EarthBound ROM,
+    and whether it has a header."""
+
+    from ROM import LazyROM
+
+    useCache(args)
+    ok = True
+    for romPath in args.roms:
+        rom = LazyROM(romPath)
+        if rom.clean:
+            status = "clean"
+        elif rom.valid:
+            status = "unclean"
+        else:
+            status = "invalid"
+            ok = False
+        out.write("{}\t{}\t{}\n".format(status, "headered" if rom.header else
+                                        "unheadered", romPath))
+
+    return 0 if ok else 1
+
+
+########
+# MAIN #
+########
+
+def main(argv=None):
+    """Runs a command; returns its exit status."""
+
+    parser = argparse.ArgumentParser(description="Applies, creates and checks "
+                                     "EarthBound ROM patches. Use - to read "
+                                     "from the standard input or write to the "
+                                     "standard output.")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="print what is done to the standard error")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="don't remember what ROMs were identified as")
+    commands = parser.add_subparsers(dest="command")
+
+    apply = commands.add_parser("apply", help="apply a patch to a ROM, in "
+                                "place unless an output is given")
+    apply.add_argument("patch", help="the EBP or IPS patch")
+    apply.add_argument("rom", help="the ROM to patch")
+    apply.add_argument("-o", "--output", help="the patched ROM to write")
+    apply.add_argument("--headered", action="store_true",
+                       help="the patch is for headered ROMs")
+    apply.set_defaults(run=applyCommand)
+
+    create = commands.add_parser("create", help="create an EBP patch")
+    create.add_argument("clean", help="the clean EarthBound ROM")
+    create.add_argument("hacked", help="the hacked ROM")
+    create.add_argument("-o", "--output", default=STDIO,
+                        help="the patch to write")
+    create.add_argument("--title", default="")
+    create.add_argument("--author", default="")
+    create.add_argument("--description", default="")
+    create.add_argument("--optimize", action="store_true",
+                        help="make the patch as small as possible")
+    create.add_argument("--reversible", action="store_true",
+                        help="make the patch undoable")
+    create.set_defaults(run=createCommand)
+
+    verify = commands.add_parser("verify", help="check that a ROM is clean and "
+                                 "that a patch can be applied to it")
+    verify.add_argument("rom", help="the ROM to check")
+    verify.add_argument("patch", nargs="?", help="the patch to check")
+    verify.add_argument("--headered", action="store_true",
+                        help="the patch is for headered ROMs")
+    verify.set_defaults(run=verifyCommand)
+
+    info = commands.add_parser("info", help="describe a patch")
+    info.add_argument("patch", help="the EBP or IPS patch")
+    info.add_argument("--headered", action="store_true",
+                      help="the patch is for headered ROMs")
+    info.set_defaults(run=infoCommand)
+
+    identify = commands.add_parser("identify", help="identify ROMs")
+    identify.add_argument("roms", nargs="+", help="the ROMs to identify")
+    identify.set_defaults(run=identifyCommand)
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help(sys.stderr)
+        return 2
+
+    # Keep the standard output for the results.
+    out = sys.stdout
+    quiet = sys.stderr if args.verbose else open(os.devnull, "w")
+    sys.stdout = quiet
+    try:
+        return args.run(args, out)
+    except (IOError, ValueError) as e:
+        sys.stderr.write("{}\n".format(e))
+        return 1
+    finally:
+        out.flush()
+        sys.stdout = out
+        if quiet is not sys.stderr:
+            quiet.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
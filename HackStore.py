@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+"""
+    EarthBound Patcher - An easy-to-use EarthBound ROM patcher.
+    Copyright (C) 2013  Lyrositor <gagne.marc@gmail.com>
+
+    This file is part of EarthBound Patcher.
+
+    EarthBound Patcher is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    EarthBound Patcher is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with EarthBound Patcher.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# HackStore
+# Keeps hacks as patches of a single clean ROM, and builds their ROMs on demand.
+
+import argparse
+from collections import OrderedDict
+from hashlib import sha256
+from io import BytesIO
+import json
+import os
+import sys
+
+from Diff import *
+from EBPPatch import *
+from ROM import *
+
+# The amount of patched ROM data kept in memory, once built.
+MATERIALIZED_CACHE_SIZE = 0x4000000
+
+
+def patchHash(data):
+    """Returns the hash a patch's data is stored under."""
+
+    return sha256(data).hexdigest()
+
+
+class HackStore:
+    """A directory holding one normalized clean ROM, named after its MD5
+    checksum, and patches of it, named after the hash of their contents. The
+    patched ROMs are only built when asked for, and the most recently used ones
+    are kept in memory."""
+
+    def __init__(self, root, cacheSize=MATERIALIZED_CACHE_SIZE):
+        """Opens the store, creating its directory if needed."""
+
+        self.root = root
+        self.cacheSize = cacheSize
+        os.makedirs(os.path.join(root, "patches"), exist_ok=True)
+
+        # The clean ROM, once loaded, and the patched ROMs built from it, with
+        # their sizes.
+        self.cleanROM = None
+        self.materialized = OrderedDict()
+        self.materializedSize = 0
+
+    def cleanPath(self):
+        """Returns the path of the clean ROM."""
+
+        return os.path.join(self.root, EB_MD5 + ".sfc")
+
+    def patchPath(self, hashHex):
+        """Returns the path of the patch with the given hash."""
+
+        return os.path.join(self.root, "patches", hashHex[:2], hashHex)
+
+    def __contains__(self, hashHex):
+        return os.path.isfile(self.patchPath(hashHex))
+
+    def hashes(self):
+        """Returns the hashes of the patches in the store."""
+
+        patches = os.path.join(self.root, "patches")
+        return sorted(h for d in os.listdir(patches) for h in
+                      os.listdir(os.path.join(patches, d)) if
+                      not h.endswith(".tmp"))
+
+    def write(self, path, data):
+        """Writes a file of the store, so that it is never seen half written."""
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+    def addClean(self, romPath):
+        """Stores the clean ROM, without its header or any of the fixes made
+        while loading it."""
+
+        rom = ROM(romPath, repair=True)
+        if not rom.clean:
+            raise ValueError("{} is not a known clean ROM.".format(romPath))
+        with rom.getbuffer() as b:
+            self.write(self.cleanPath(), b)
+        self.cleanROM = None
+
+    def loadClean(self):
+        """Returns the clean ROM, loading it the first time."""
+
+        if self.cleanROM is None:
+            try:
+                rom = ROM(self.cleanPath())
+            except IOError:
+                raise ValueError("The store has no clean ROM.")
+            if not rom.clean:
+                raise ValueError("The store's clean ROM is not clean.")
+            self.cleanROM = rom
+
+        return self.cleanROM
+
+    def add(self, patchPath):
+        """Stores an EBP or IPS patch for unheadered ROMs; returns its hash."""
+
+        with open(patchPath, "rb") as f:
+            data = f.read()
+        patch = EBPPatch(None, data=data)
+        if not patch.valid or patch.records is None:
+            raise ValueError("{} is not a valid patch.".format(patchPath))
+
+        hashHex = patchHash(data)
+        if hashHex not in self:
+            self.write(self.patchPath(hashHex), data)
+
+        return hashHex
+
+    def addROM(self, romPath, metadata):
+        """Stores a hacked ROM as an EBP patch of the clean ROM, with the given
+        metadata; returns the patch's hash."""
+
+        hackedROM = LazyROM(romPath)
+        if not hackedROM.valid:
+            raise ValueError("{} is not a valid ROM.".format(romPath))
+
+        # Diff the ROM against the clean ROM, and write the patch in memory.
+        source = self.loadClean().getvalue()
+        target = hackedROM.getvalue()
+        runs = findRuns(source, target, padded=True)
+        records = makeRecords(runs, target, len(source), True)
+        f = BytesIO()
+        EBPPatch(None, True).writePatch(f, records, target, metadata, True)
+
+        data = f.getvalue()
+        hashHex = patchHash(data)
+        if hashHex not in self:
+            self.write(self.patchPath(hashHex), data)
+
+        return hashHex
+
+    def loadPatch(self, hashHex):
+        """Returns the patch with the given hash, checking its contents."""
+
+        try:
+            with open(self.patchPath(hashHex), "rb") as f:
+                data = f.read()
+        except IOError:
+            raise KeyError(hashHex)
+        if patchHash(data) != hashHex:
+            raise ValueError("The patch {} is corrupt.".format(hashHex))
+
+        return EBPPatch(None, data=data)
+
+    def get(self, hashHex):
+        """Returns the clean ROM with the patch applied, built in memory. The
+        ROM is shared with later calls; copy it before modifying it."""
+
+        if hashHex in self.materialized:
+            self.materialized.move_to_end(hashHex)
+            return self.materialized[hashHex][0]
+
+        # Apply the patch to a copy of the clean ROM, which has no file.
+        patch = self.loadPatch(hashHex)
+        rom = self.loadClean().copy()
+        rom.romPath = None
+        rom.clean = False
+        patch.applyToTarget(rom)
+        size = rom.seek(0, 2)
+        rom.seek(0)
+
+        # Forget the least recently used ROMs if there are too many.
+        self.materialized[hashHex] = rom, size
+        self.materializedSize += size
+        while self.materializedSize > self.cacheSize and \
+              len(self.materialized) > 1:
+            self.materializedSize -= self.materialized.popitem(False)[1][1]
+
+        return rom
+
+
+########
+# MAIN #
+########
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stores hacks as patches of "
+                                     "the clean ROM, and builds their ROMs.")
+    parser.add_argument("store", help="the directory of the store")
+    commands = parser.add_subparsers(dest="command")
+    clean = commands.add_parser("clean", help="store the clean ROM")
+    clean.add_argument("rom", help="the clean EarthBound ROM")
+    add = commands.add_parser("add", help="store patches")
+    add.add_argument("patches", nargs="+", help="unheadered EBP or IPS patches")
+    addROM = commands.add_parser("import", help="store hacked ROMs as patches")
+    addROM.add_argument("roms", nargs="+", help="the hacked ROMs")
+    get = commands.add_parser("get", help="build the ROM of a patch")
+    get.add_argument("hash", help="the hash of the patch")
+    get.add_argument("output", help="the ROM file to write")
+    args = parser.parse_args()
+
+    sys.stdout = open(os.devnull, "w")
+    store = HackStore(args.store)
+    if args.command == "clean":
+        store.addClean(args.rom)
+    elif args.command == "add":
+        for patchPath in args.patches:
+            sys.stderr.write("{} {}\n".format(store.add(patchPath), patchPath))
+    elif args.command == "import":
+        for romPath in args.roms:
+            metadata = json.dumps({"patcher": "EBPatcher", "author": "",
+                                   "description": "", "title":
+                                   os.path.splitext(os.path.basename(romPath))
+                                   [0]})
+            sys.stderr.write("{} {}\n".format(store.addROM(romPath, metadata),
+                                              romPath))
+    elif args.command == "get":
+        store.get(args.hash).writeToFile(args.output)
+    else:
+        parser.print_help(sys.stderr)
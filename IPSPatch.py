@@ -22,21 +22,201 @@
 # Handles the import of IPS patches (legacy).
 # Heavily based on the python-ips module.
 
+from array import array
+from functools import lru_cache
 from io import BytesIO
+import mmap
 import os
+import shutil
 import struct
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# The kinds of records.
+LITERAL = 0
+RLE = 1
+
+# The size of the buffer records are read into when streaming a patch.
+STREAM_BUFFER_SIZE = 0x4000
+
+# The Linux ioctl making a file share the blocks of another (a reflink).
+FICLONE = 0x40049409
+
+
+@lru_cache(maxsize=16)
+def fillBlock(value):
+    """Returns a view of the largest possible RLE run of the byte, which RLE
+    records are filled from without building their data."""
+
+    return memoryview(bytes((value,)) * 0xFFFF)
+
+
+def sameFile(path, otherPath):
+    """Checks if the other path exists and is the same file as the path."""
+
+    return os.path.exists(otherPath) and os.path.samefile(path, otherPath)
+
+
+def cloneFile(sourcePath, targetPath):
+    """Copies a file as cheaply as the system allows: by sharing its blocks if
+    the filesystem can, then by copying it within the kernel, then by reading
+    and writing it. Returns how it was copied: "clone", "range" or "copy"."""
+
+    # Opening the target would empty the source.
+    if sameFile(sourcePath, targetPath):
+        raise ValueError("Can't copy {} onto itself.".format(sourcePath))
+
+    with open(sourcePath, "rb") as src, open(targetPath, "wb") as dst:
+        # Try to make the copy share the source's blocks.
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return "clone"
+            except OSError:
+                pass
+
+        # Try to copy it without it going through Python.
+        if hasattr(os, "copy_file_range"):
+            size = os.fstat(src.fileno()).st_size
+            copied = 0
+            try:
+                while copied < size:
+                    n = os.copy_file_range(src.fileno(), dst.fileno(),
+                                           size - copied, copied, copied)
+                    if not n:
+                        break
+                    copied += n
+            except OSError:
+                pass
+            if copied == size:
+                return "range"
+            dst.truncate(0)
+
+        shutil.copyfileobj(src, dst)
+        return "copy"
+
+
+class RecordTable:
+    """The records of a patch, stored as parallel arrays of offsets, sizes and
+    kinds. The value of a literal record is the position of its data in the
+    patch's buffer, which is never copied; that of an RLE record is the byte it
+    repeats."""
+
+    def __init__(self, buffer):
+        """Creates an empty table for records whose data is in the buffer."""
+
+        self.buffer = buffer
+        self.offsets = array("I")
+        self.sizes = array("I")
+        self.kinds = array("B")
+        self.values = array("I")
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __iter__(self):
+        """Iterates over the (offset, size, kind, value) of each record."""
+
+        return zip(self.offsets, self.sizes, self.kinds, self.values)
+
+    def append(self, offset, size, kind, value):
+        """Adds a record to the table."""
+
+        self.offsets.append(offset)
+        self.sizes.append(size)
+        self.kinds.append(kind)
+        self.values.append(value)
+
+    def data(self, size, kind, value):
+        """Returns the data written by a record: a view of the patch for a
+        literal record, or the expanded bytes of an RLE record."""
+
+        if kind == RLE:
+            return bytes((value,)) * size
+        return self.buffer[value:value + size]
+
+    def items(self):
+        """Iterates over the (offset, data) of each record."""
+
+        for offset, size, kind, value in self:
+            yield offset, self.data(size, kind, value)
+
+    def end(self):
+        """Returns the offset right after the last byte written."""
+
+        return max((o + s for o, s in zip(self.offsets, self.sizes)),
+                   default=0)
+
+
+class RecordStream:
+    """Parses the records of a patch as they are read from a binary stream
+    (a file, a pipe, a socket...), through a small fixed buffer."""
+
+    def __init__(self, stream, bufferSize=STREAM_BUFFER_SIZE):
+        """Prepares to read the patch from the stream."""
+
+        self.stream = stream
+        self.buffer = memoryview(bytearray(bufferSize))
+
+        # What follows the records, once they have all been read.
+        self.tail = None
+
+    def read(self, size):
+        """Returns a view of the next bytes of the stream, in the buffer."""
+
+        view = self.buffer[:size]
+        n = 0
+        while n < size:
+            r = self.stream.readinto(view[n:])
+            if not r:
+                raise ValueError("The patch ends in the middle of a record.")
+            n += r
+        return view
+
+    def __iter__(self):
+        """Iterates over the (offset, data) written by the records, large
+        literal records being split into several pieces. The data is only
+        valid until the next piece is read."""
+
+        if self.read(5) != b"PATCH":
+            raise ValueError("Invalid IPS patch.")
+
+        while True:
+            header = self.read(3)
+            if header == b"EOF":
+                self.tail = self.stream.read()
+                return
+            offset = int.from_bytes(header, "big")
+            size = int.from_bytes(self.read(2), "big")
+
+            # If it's an RLE record, fill it from its value.
+            if size == 0:
+                size, value = struct.unpack(">HB", self.read(3))
+                yield offset, fillBlock(value)[:size]
+
+            # Otherwise, pass its data on a buffer at a time.
+            else:
+                for i in range(0, size, len(self.buffer)):
+                    yield offset + i, self.read(min(size - i,
+                                                    len(self.buffer)))
+
 
 class IPSPatch(BytesIO):
     """The legacy patch format class, used to import patches."""
 
-    def __init__(self, patchPath, new=False):
-        """Loads an existing IPS patch."""
+    def __init__(self, patchPath, new=False, data=None):
+        """Loads an existing IPS patch, from its file or from its data."""
 
         if not new:
             # Initialize the data.
-            super().__init__(open(patchPath, "rb").read())
+            if data is None:
+                data = open(patchPath, "rb").read()
+            super().__init__(data)
             self.header = 0
+            self.size = None
 
             # Check its validity and load the records.
             self.valid = self.checkValidity()
@@ -56,52 +236,166 @@ class IPSPatch(BytesIO):
     def loadRecords(self):
         """Loads the IPS records from the patch."""
 
-        # Position the cursor at the start of the first record.
-        self.seek(5)
+        # The patch's data is viewed, not copied.
+        buffer = memoryview(self.getvalue())
+        records = RecordTable(buffer)
+        end = len(buffer)
 
-        # Start loading the records.
-        records = {}
+        # Start loading the records after the "PATCH" string.
+        i = 5
         while True:
 
-            # Read until an EOF is encountered.
-            i = self.read(3)
-            if i == b"EOF":
-                break
-
             # If the end has been reached, the patch is corrupt.
-            if not i:
+            if i + 3 > end:
                 return None
 
-            self.seek(-3, os.SEEK_CUR)
+            # Read until an EOF is encountered. If it is followed by exactly
+            # three bytes, they are the size to truncate the ROM to.
+            if buffer[i:i + 3] == b"EOF":
+                i += 3
+                if end - i == 3:
+                    self.size = int.from_bytes(buffer[i:end], "big")
+                self.seek(i)
+                break
 
             # Get the record details.
-            offset = int.from_bytes(self.read(3), "big")
-            size = int.from_bytes(self.read(2), "big")
+            if i + 5 > end:
+                return None
+            high, low, size = struct.unpack_from(">BHH", buffer, i)
+            offset = high << 16 | low
+            i += 5
 
-            # If it's an RLE record, treat it as such.
+            # If it's an RLE record, keep its value instead of expanding it.
             if size == 0:
-                i = self.read(2)
-                sizeRLE = int.from_bytes(i, "big")
-                diff = self.read(1) * sizeRLE
+                if i + 3 > end:
+                    return None
+                size, value = struct.unpack_from(">HB", buffer, i)
+                records.append(offset, size, RLE, value)
+                i += 3
 
-            # Otherwise, read it as a normal record.
+            # Otherwise, keep where its data is in the patch.
             else:
-                diff = self.read(size)
-
-            records[offset] = diff
+                if i + size > end:
+                    return None
+                records.append(offset, size, LITERAL, i)
+                i += size
 
         return records
 
     def applyToTarget(self, rom):
         """Applies the patch to the target ROM's data."""
 
-        # Expand the ROM if necessary.
-        last = sorted(self.records)[len(self.records) - 1]
-        newSize = last + len(self.records[last]) - self.header
-        if newSize > len(rom.getvalue()):
-            rom.modifySize(newSize)
+        # Work out the final size: the one stored in the patch if there is one,
+        # otherwise enough to hold every record.
+        end = self.records.end() - self.header
+        current = rom.seek(0, os.SEEK_END)
+        size = max(current, end)
+        if self.size is not None:
+            size = self.size - self.header
+
+        # Resize the ROM's buffer once, to fit every record.
+        if max(size, end) != current:
+            rom.truncate(max(size, end))
+            if max(size, end) > current:
+                rom.seek(max(size, end) - 1)
+                rom.write(b"\x00")
+
+        # Apply the records directly to the ROM's buffer.
+        with rom.getbuffer() as view:
+            buffer = self.records.buffer
+            for offset, length, kind, value in self.records:
+                offset -= self.header
+                if offset < 0:
+                    raise ValueError("Record before the start of the ROM.")
+                if kind == RLE:
+                    view[offset:offset + length] = fillBlock(value)[:length]
+                else:
+                    view[offset:offset + length] = buffer[value:value + length]
+
+        # Truncate the ROM if the patch shrinks it.
+        if size < max(size, end):
+            rom.truncate(size)
+
+    def applyToFile(self, romPath, romHeader=0):
+        """Applies the patch in place to a ROM file, as it is: the file's header
+        is skipped over rather than removed, and no repairs are made. Only the
+        bytes which actually change are written; returns how many were."""
+
+        with open(romPath, "r+b") as f:
+            end = self.records.end() - self.header
+            current = os.fstat(f.fileno()).st_size - romHeader
+            size = max(current, end)
+            if self.size is not None:
+                size = self.size - self.header
+
+            # Resize the file once, to fit every record.
+            if max(size, end) > current:
+                f.truncate(romHeader + max(size, end))
+
+            # Map the file and write the records which change it.
+            written = 0
+            with mmap.mmap(f.fileno(), 0) as m:
+                buffer = self.records.buffer
+                for offset, length, kind, value in self.records:
+                    offset += romHeader - self.header
+                    if offset < romHeader:
+                        raise ValueError("Record before the start of the ROM.")
+                    if kind == RLE:
+                        data = fillBlock(value)[:length]
+                    else:
+                        data = buffer[value:value + length]
+                    if m[offset:offset + length] != data:
+                        m[offset:offset + length] = data
+                        written += length
+
+            # Truncate the file if the patch shrinks it.
+            if size < max(size, current, end):
+                f.truncate(romHeader + size)
+
+        return written
+
+    def applyToCopy(self, romPath, outPath, romHeader=0):
+        """Applies the patch to a copy of a ROM file, which is left untouched.
+        The copy shares the file's blocks where the filesystem allows it, and
+        only the bytes which change are then written to it; returns how many
+        were. If the copy would be the ROM file itself, it is patched in
+        place."""
+
+        if not sameFile(romPath, outPath):
+            cloneFile(romPath, outPath)
+        return self.applyToFile(outPath, romHeader)
+
+    @classmethod
+    def applyStream(cls, stream, rom, patchHeader=0, romHeader=0):
+        """Applies a patch to a ROM's data or file, as the patch is read from
+        the stream; only a small buffer of it is held in memory. The ROM's
+        header is skipped over. Returns the number of bytes written."""
+
+        records = RecordStream(stream)
+        written = 0
+        for offset, data in records:
+            offset += romHeader - patchHeader
+            if offset < romHeader:
+                raise ValueError("Record before the start of the ROM.")
+            rom.seek(offset)
+            rom.write(data)
+            written += len(data)
+
+        # Resize the ROM if the patch ends with a size.
+        size = cls.streamSize(records.tail)
+        if size is not None:
+            size += romHeader - patchHeader
+            if rom.seek(0, os.SEEK_END) < size:
+                rom.seek(size - 1)
+                rom.write(b"\x00")
+            rom.truncate(size)
+
+        return written
+
+    @staticmethod
+    def streamSize(tail):
+        """Returns the size stored after the end of a streamed patch, if any."""
 
-        # Apply the records.
-        for offset, diff in self.records.items():
-            rom.seek(offset - self.header)
-            rom.write(diff)
+        if len(tail) == 3:
+            return int.from_bytes(tail, "big")
+        return None
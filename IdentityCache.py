@@ -0,0 +1,123 @@
+"""
+    EarthBound Patcher - An easy-to-use EarthBound ROM patcher.
+    Copyright (C) 2013  Lyrositor <gagne.marc@gmail.com>
+
+    This file is part of EarthBound Patcher.
+
+    EarthBound Patcher is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    EarthBound Patcher is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with EarthBound Patcher.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# IdentityCache
+# Remembers what each ROM file was identified as, across runs.
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Where the cache is kept by default.
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "ebpatcher",
+                          "identity.sqlite")
+
+# The number of ROM files remembered; the least recently used are forgotten.
+MAX_ENTRIES = 1000
+
+# How old a file must be for its verdict to be stored. A file modified more
+# recently could be modified again without its modification time changing.
+RACY_TIME = 2 * 10 ** 9
+
+
+def fileIdentity(path):
+    """Returns the path, size, modification time and inode of a file, which
+    change whenever it does."""
+
+    s = os.stat(path)
+    return os.path.abspath(path), s.st_size, s.st_mtime_ns, s.st_ino
+
+
+class IdentityCache:
+    """An on-disk cache of ROM verdicts, keyed by each file's path, size,
+    modification time and inode. It can be shared by several processes."""
+
+    def __init__(self, path=CACHE_PATH, maxEntries=MAX_ENTRIES):
+        """Opens the cache, creating it if needed."""
+
+        self.path = path
+        self.maxEntries = maxEntries
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS verdicts ("
+                            "path TEXT PRIMARY KEY, size INTEGER, "
+                            "mtime INTEGER, inode INTEGER, verdict TEXT, "
+                            "used INTEGER)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS used ON verdicts "
+                            "(used)")
+
+    def get(self, romPath):
+        """Returns the verdict stored for the file, or None if there is none or
+        the file changed since."""
+
+        try:
+            path, size, mtime, inode = fileIdentity(romPath)
+            with self.lock, self.db:
+                row = self.db.execute("SELECT verdict FROM verdicts WHERE "
+                                      "path = ? AND size = ? AND mtime = ? "
+                                      "AND inode = ?", (path, size, mtime,
+                                                        inode)).fetchone()
+                if row is None:
+                    return None
+                self.db.execute("UPDATE verdicts SET used = ? WHERE path = ?",
+                                (time.time_ns(), path))
+            return json.loads(row[0])
+        except (OSError, ValueError, sqlite3.Error):
+            print("IdentityCache.get(): Could not read the cache.")
+            return None
+
+    def put(self, romPath, verdict):
+        """Stores the verdict for the file, forgetting the least recently used
+        files if there are too many."""
+
+        try:
+            path, size, mtime, inode = fileIdentity(romPath)
+            now = time.time_ns()
+            if now - mtime < RACY_TIME:
+                return
+            with self.lock, self.db:
+                self.db.execute("INSERT OR REPLACE INTO verdicts VALUES "
+                                "(?, ?, ?, ?, ?, ?)", (path, size, mtime, inode,
+                                json.dumps(verdict), now))
+                self.db.execute("DELETE FROM verdicts WHERE path NOT IN "
+                                "(SELECT path FROM verdicts ORDER BY used DESC "
+                                "LIMIT ?)", (self.maxEntries,))
+        except (OSError, sqlite3.Error):
+            print("IdentityCache.put(): Could not write to the cache.")
+
+    def remove(self, romPath):
+        """Forgets the verdict stored for the file, if any."""
+
+        try:
+            with self.lock, self.db:
+                self.db.execute("DELETE FROM verdicts WHERE path = ?",
+                                (os.path.abspath(romPath),))
+        except sqlite3.Error:
+            print("IdentityCache.remove(): Could not write to the cache.")
+
+    def close(self):
+        """Closes the cache."""
+
+        self.db.close()
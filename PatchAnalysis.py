@@ -0,0 +1,165 @@
+"""
+    EarthBound Patcher - An easy-to-use EarthBound ROM patcher.
+    Copyright (C) 2013  Lyrositor <gagne.marc@gmail.com>
+
+    This file is part of EarthBound Patcher.
+
+    EarthBound Patcher is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    EarthBound Patcher is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with EarthBound Patcher.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# PatchAnalysis
+# Checks what a patch would do to a ROM without applying it.
+
+from bisect import bisect_left
+
+from IPSPatch import *
+
+# The size of an unexpanded EarthBound ROM.
+ROM_SIZE = 0x300000
+
+# The largest size an (ExHiROM) EarthBound ROM can be expanded to.
+MAX_ROM_SIZE = 0x600000
+
+
+class IntervalIndex:
+    """A sorted index of the (start, end, record) ranges written by a patch's
+    records, with the offsets relative to the start of the ROM."""
+
+    def __init__(self, intervals):
+        """Sorts the intervals; a record's index breaks ties, so that records
+        starting at the same offset keep the order they are applied in."""
+
+        self.intervals = sorted(intervals)
+        self.starts = [start for start, end, record in self.intervals]
+
+        # The largest end of any interval up to each one, to bound searches.
+        self.maxEnds = []
+        maxEnd = 0
+        for start, end, record in self.intervals:
+            maxEnd = max(maxEnd, end)
+            self.maxEnds.append(maxEnd)
+
+    @classmethod
+    def fromPatch(cls, patch):
+        """Builds the index of a loaded patch's records."""
+
+        return cls((offset - patch.header, offset - patch.header + size, i)
+                   for i, (offset, size, kind, value) in
+                   enumerate(patch.records))
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def find(self, start, end):
+        """Returns the intervals which overlap the range."""
+
+        found = []
+        i = bisect_left(self.starts, end) - 1
+        while i >= 0 and self.maxEnds[i] > start:
+            if self.intervals[i][1] > start:
+                found.append(self.intervals[i])
+            i -= 1
+        found.reverse()
+        return found
+
+    def overlaps(self):
+        """Returns the (first record, second record, start, end) of every pair
+        of records which write to the same bytes, in order of the second."""
+
+        overlaps = []
+        active = []
+        for start, end, record in self.intervals:
+            active = [a for a in active if a[1] > start]
+            for aStart, aEnd, aRecord in active:
+                overlaps.append((min(aRecord, record), max(aRecord, record),
+                                 start, min(aEnd, end)))
+            active.append((start, end, record))
+        return overlaps
+
+    def merged(self):
+        """Returns the disjoint (start, end) ranges written to by the records."""
+
+        merged = []
+        for start, end, record in self.intervals:
+            if merged and start <= merged[-1][1]:
+                if end > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], end)
+            else:
+                merged.append((start, end))
+        return merged
+
+
+class PreflightReport:
+    """What applying a patch would do to a ROM."""
+
+    def __init__(self, patch, romSize=ROM_SIZE):
+        """Analyzes the patch's records for a ROM of the given size."""
+
+        self.index = IntervalIndex.fromPatch(patch)
+        self.records = len(self.index)
+        self.overlaps = self.index.overlaps()
+        self.writeSet = self.index.merged()
+        self.written = sum(end - start for start, end in self.writeSet)
+
+        # Work out the size the ROM will end up with.
+        end = self.writeSet[-1][1] if self.writeSet else 0
+        if patch.size is not None:
+            self.finalSize = patch.size - patch.header
+        else:
+            self.finalSize = max(romSize, end)
+
+        # Find the records which can't be applied as they are: those before the
+        # start of the ROM (usually in the header, for a patch which is not
+        # headered), and those past the largest possible ROM.
+        self.headerRecords = []
+        self.expanding = []
+        self.outOfRange = []
+        for start, end, record in self.index.intervals:
+            if start < 0:
+                self.headerRecords.append(record)
+            if end > MAX_ROM_SIZE:
+                self.outOfRange.append(record)
+            elif end > romSize:
+                self.expanding.append(record)
+
+    def valid(self):
+        """Returns whether or not the patch can be applied safely."""
+
+        return not self.headerRecords and not self.outOfRange
+
+    def describe(self):
+        """Returns the report as lines of text."""
+
+        lines = ["{} records writing {} bytes in {} ranges.".format(
+                 self.records, self.written, len(self.writeSet)),
+                 "Final ROM size: {:#x}.".format(self.finalSize)]
+        for first, second, start, end in self.overlaps:
+            lines.append("Records {} and {} overlap at {:#x}-{:#x}.".format(
+                         first, second, start, end))
+        if self.expanding:
+            lines.append("{} records expand the ROM.".format(
+                         len(self.expanding)))
+        for record in self.headerRecords:
+            lines.append("Record {} is before the start of the ROM; the header "
+                         "setting may be wrong.".format(record))
+        for record in self.outOfRange:
+            lines.append("Record {} is past the largest possible ROM.".format(
+                         record))
+        return lines
+
+
+def analyzePatch(patch, romSize=ROM_SIZE):
+    """Returns the pre-flight report of a loaded patch."""
+
+    return PreflightReport(patch, romSize)
@@ -0,0 +1,221 @@
+"""
+    EarthBound Patcher - An easy-to-use EarthBound ROM patcher.
+    Copyright (C) 2013  Lyrositor <gagne.marc@gmail.com>
+
+    This file is part of EarthBound Patcher.
+
+    EarthBound Patcher is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    EarthBound Patcher is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with EarthBound Patcher.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# PatchStack
+# Flattens several patches, applied one after the other, into a single one.
+
+from bisect import bisect_right
+from io import BytesIO
+import json
+
+from Diff import *
+from IPSPatch import *
+
+# The end of the offsets an IPS record can write to.
+IPS_END = 0x1000000
+
+
+class IntervalMap:
+    """Disjoint (start, end) ranges mapped to values; a range added later
+    replaces whatever parts of the earlier ones it overlaps."""
+
+    def __init__(self):
+        """Creates an empty map."""
+
+        self.starts = []
+        self.ends = []
+        self.values = []
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        """Iterates over the (start, end, value) of each range, in order."""
+
+        return zip(self.starts, self.ends, self.values)
+
+    def add(self, start, end, value):
+        """Maps the range to the value, splitting the ranges it overlaps."""
+
+        # Find the ranges which overlap the new one.
+        i = bisect_right(self.starts, start) - 1
+        if i < 0 or self.ends[i] <= start:
+            i += 1
+        j = i
+        while j < len(self.starts) and self.starts[j] < end:
+            j += 1
+
+        # Keep the parts of the first and last of them outside the new range.
+        starts = [start]
+        ends = [end]
+        values = [value]
+        if i < j:
+            if self.starts[i] < start:
+                starts.insert(0, self.starts[i])
+                ends.insert(0, start)
+                values.insert(0, self.values[i])
+            if self.ends[j - 1] > end:
+                starts.append(end)
+                ends.append(self.ends[j - 1])
+                values.append(self.values[j - 1])
+
+        self.starts[i:j] = starts
+        self.ends[i:j] = ends
+        self.values[i:j] = values
+
+    def find(self, offset):
+        """Returns the index of the range containing the offset, or None."""
+
+        i = bisect_right(self.starts, offset) - 1
+        if i >= 0 and self.ends[i] > offset:
+            return i
+        return None
+
+
+class PatchStack:
+    """The combined effect of several patches applied in order, the last one
+    to write to a byte winning. The result is a single patch, which can be
+    applied in one pass."""
+
+    def __init__(self, patches):
+        """Merges the records of the loaded patches, each with its header
+        already set."""
+
+        self.patches = patches
+        self.writes = IntervalMap()
+        self.size = None
+
+        # Each range is mapped to (record start, kind, patch buffer, value), so
+        # that its data can be found however much of it is left.
+        for patch in patches:
+            end = 0
+            for offset, size, kind, value in patch.records:
+                offset -= patch.header
+                if offset < 0:
+                    raise ValueError("Record before the start of the ROM.")
+                self.writes.add(offset, offset + size,
+                                (offset, kind, patch.records.buffer, value))
+                end = max(end, offset + size)
+
+            # A patch which resizes the ROM removes everything past its size;
+            # anything later written past it is written over zeros.
+            if patch.size is not None:
+                self.size = patch.size - patch.header
+                self.writes.add(self.size, IPS_END,
+                                (self.size, RLE, None, 0))
+            elif self.size is not None:
+                self.size = max(self.size, end)
+
+    def __getitem__(self, key):
+        """Returns a byte, or a slice of the bytes, written by the stack."""
+
+        if isinstance(key, slice):
+            return b"".join(self.pieces(key.start, key.stop))
+        return self.pieces(key, key + 1)[0][0]
+
+    def pieces(self, start, end):
+        """Returns the data written to the range, which must all be written,
+        as a list of pieces."""
+
+        pieces = []
+        i = self.writes.find(start)
+        while start < end:
+            if i is None or i >= len(self.writes) or \
+               self.writes.starts[i] > start:
+                raise ValueError("{:#x} is not written by the patches.".format(
+                                 start))
+            b = min(end, self.writes.ends[i])
+            origin, kind, buffer, value = self.writes.values[i]
+            if kind == RLE:
+                pieces.append(bytes((value,)) * (b - start))
+            else:
+                pieces.append(buffer[value + start - origin:
+                                     value + b - origin])
+            start = b
+            i += 1
+
+        return pieces
+
+    def records(self):
+        """Returns the stack's (offset, size, value) records, merging the
+        literal ranges which touch."""
+
+        ranges = []
+        for start, end, (origin, kind, buffer, value) in self.writes:
+            if self.size is not None:
+                end = min(end, self.size)
+                if start >= end:
+                    break
+            value = value if kind == RLE else None
+            if ranges and ranges[-1][1] == start and ranges[-1][2] == value:
+                ranges[-1] = (ranges[-1][0], end, value)
+            else:
+                ranges.append((start, end, value))
+
+        records = []
+        for start, end, value in ranges:
+            addRecord(records, start, end - start, value, self)
+
+        return records
+
+    def mergeMetadata(self):
+        """Returns the EBP metadata of the stack, combining that of the EBP
+        patches in it."""
+
+        titles = []
+        authors = []
+        descriptions = []
+        for patch in self.patches:
+            info = getattr(patch, "info", None)
+            if not info:
+                continue
+            titles.append(info["title"])
+            if info["author"] not in authors:
+                authors.append(info["author"])
+            descriptions.append(info["description"])
+
+        return json.dumps({"patcher": "EBPatcher", "title": " + ".join(titles),
+                           "author": ", ".join(authors),
+                           "description": "\n\n".join(descriptions)})
+
+    def writePatch(self, f, metadata=None):
+        """Writes the stack as an EBP patch with the given metadata, or as an
+        IPS patch if there is none. The size the ROM ends up with is stored in
+        the metadata, or after the end of an IPS patch."""
+
+        f.write(b"PATCH")
+        writeRecords(f, self.records(), self)
+        f.write(b"EOF")
+        if metadata is not None:
+            if self.size is not None:
+                info = json.loads(metadata)
+                info["size"] = self.size
+                metadata = json.dumps(info)
+            f.write(bytes(metadata, "utf-8"))
+        elif self.size is not None:
+            f.write(self.size.to_bytes(3, "big"))
+
+    def flatten(self):
+        """Returns the stack as a single IPS patch, loaded in memory."""
+
+        f = BytesIO()
+        self.writePatch(f)
+
+        return IPSPatch(None, data=f.getvalue())
@@ -22,8 +22,12 @@
 # Handles read and write operations to EarthBound ROMs.
 
 from io import BytesIO
-from hashlib import md5
+from hashlib import md5, sha1
+import os
+import zlib
 
+from BlockDB import *
+from IdentityCache import *
 from IPSPatch import *
 
 # Unheadered, clean ROM.
@@ -41,97 +45,229 @@ EB_WRONG_MD5 = {"8c28ce81c7d359cf9ccaa00d41f8ad33": "patches/wrong1.ips",
 # ExHiROM expanded ROMs have two bytes different from LoROM.
 EXHIROM_DIFF = {0xffd5: 0x31, 0xffd7: 0x0c}
 
+# The amount of data read from a ROM file at once.
+READ_SIZE = 0x10000
+
 # The identification string for EarthBound ROMs.
 ID = b"EARTH BOUND"
 
+# The amount of data hashed at once when fingerprinting a ROM.
+FINGERPRINT_SIZE = 0x80000
+
+# The threads hashing fingerprints, created when they are first needed.
+hashPool = None
+
+
+def checkHeaderData(d):
+    """Returns the size of the header at the start of the data, if any."""
+
+    header = 0
+    try:
+        # Check for a headered HiROM.
+        if ~d[0x101dc] & 0xff == d[0x101de] and \
+           ~d[0x101dd] & 0xff == d[0x101df] and \
+           d[0x101c0:0x101c0 + len(ID)] == ID:
+            header = 0x200
+    except IndexError:
+        pass
+
+    try:
+        # Check for a headered LoROM.
+        if ~d[0x81dc] & 0xff == d[0x81de] and \
+           ~d[0x81dd] & 0xff == d[0x81df] and \
+           d[0x101c0:0x101c0 + len(ID)] == ID:
+            header = 0x200
+    except IndexError:
+        pass
+
+    return header
+
 
 class ROM(BytesIO):
     """A container for manipulating EarthBound ROM data as a file."""
 
-    def __init__(self, source, new=False):
-        """Loads the ROM's data in a buffer or copies an existing ROM."""
+    # The IdentityCache remembering what ROM files were identified as, if any.
+    cache = None
+
+    def __init__(self, source, new=False, repair=False):
+        """Loads the ROM's data in a buffer or copies an existing ROM. Only a
+        ROM loaded to be repaired, as clean ROMs are, has the blocks in which
+        it differs from the clean ROM repaired; in any other ROM, they could
+        be a hack's changes."""
+
+        # The checksums of the data as it was read, and of the ways it could be
+        # fixed, if it was hashed.
+        self.fingerprints = {}
+
+        # The blocks in which the ROM differs from the clean ROM, if it is
+        # unknown and they were looked for.
+        self.badBlocks = []
 
         if not new:
-            # Initialize the ROM's data.
-            super().__init__(open(source, "rb").read())
+            # Look for what the file was identified as the last time, unless
+            # its blocks were repaired then and aren't to be now, or the other
+            # way around.
             self.romPath = source
-            self.clean = False
-            self.valid = False
-
-            # Check if there is a header; if there is one, remove it.
-            self.header = self.checkHeader()
-            if self.header:
-                self.removeHeader()
-
-            # Check if the ROM is big enough and if it's expanded; if it is, remove
-            # the unused expanded space.
-            if len(self.getvalue()) < 0x300000:
-                return
-            if len(self.getvalue()) > 0x300000 and self.checkExpanded():
-                self.removeExpanded()
-
-            # Check the MD5 checksum, and try to fix the ROM if it's incorrect.
-            if not self.checkMD5():
-                self.repairROM()
-
-            # If we couldn't fix the ROM, try to remove a 0xff byte at the end.
-            if not self.checkMD5():
-                b = bytearray(self.getvalue())
-                if b[len(b) - 1] == 0xFF:
-                    b[len(b) - 1] = 0
-                if self.checkMD5(b):
-                    b = self.getbuffer()
-                    b[len(b) - 1] = 0
-                    del b
-
-            # Perform a final MD5 check for its validity. If it fails, check if
-            # it's at least an EarthBound ROM.
-            if self.checkMD5():
-                self.clean = True
-                self.valid = True
-                print("ROM.__init__(): Clean EarthBound ROM.")
-            elif self.checkEarthBound():
-                self.valid = True
-                print("ROM.__init__(): Unclean EarthBound ROM.")
-            else:
-                print("ROM.__init__(): Invalid EarthBound ROM.")
+            verdict = self.cache.get(source) if self.cache else None
+            if verdict is not None and (repair and not verdict["clean"] or
+                                        verdict.get("blocks") and not repair):
+                verdict = None
+
+            # Read the ROM's data once, without its header if it has one. The
+            # buffer is then only ever viewed and modified in place.
+            with open(source, "rb") as f:
+                if verdict is None:
+                    header = self.checkHeader(FileBytes(f))
+                else:
+                    header = verdict["header"]
+                f.seek(header)
+                super().__init__(f.read())
+
+            # Fix the ROM the way it was fixed last time. If one of the fixes
+            # can't be made from here, such as a repair patch which isn't
+            # found, the verdict doesn't hold; read the ROM again and forget it.
+            if verdict is not None and not self.replay(verdict):
+                with open(source, "rb") as f:
+                    f.seek(header)
+                    super().__init__(f.read())
+                self.cache.remove(source)
+                verdict = None
+
+            # Otherwise, identify the ROM, remembering the verdict unless it
+            # depends on a fix which couldn't be made.
+            if verdict is None:
+                verdict = self.identify(header, repair)
+                if self.cache and not verdict.pop("unfixed", False):
+                    self.cache.put(source, verdict)
+            self.header = verdict["header"]
+            self.clean = verdict["clean"]
+            self.valid = verdict["valid"]
+
+            # Whether the data was fixed, so is no longer that of the file.
+            self.fixed = bool(verdict["expanded"] or verdict["repair"] or
+                              verdict["trailing"] or verdict.get("blocks"))
 
         else:
-            # Copy the source ROM's information.
-            super().__init__(source.getvalue())
+            # Copy the source ROM's information, and its data straight away
+            # rather than sharing it until either of them is modified.
+            with source.getbuffer() as b:
+                super().__init__(b)
             self.romPath = source.romPath
             self.clean = source.clean
             self.valid = source.valid
             self.header = source.header
+            self.fixed = source.fixed
 
     def copy(self):
         """Returns a copy of the ROM."""
 
         return ROM(self, True)
 
-    def checkHeader(self):
-        """Check to see if the ROM is headered or not."""
+    def identify(self, header, repair=False):
+        """Checks which ROM this is, fixing it on the way to a clean ROM if it
+        can be; returns the verdict, which says how. The blocks which differ
+        from the clean ROM are only repaired if asked to."""
 
-        header = 0
-        d = self.getvalue()
-        try:
-            # Check for a headered HiROM.
-            if ~d[0x101dc] & 0xff == d[0x101de] and \
-               ~d[0x101dd] & 0xff == d[0x101df] and \
-               d[0x101c0:0x101c0 + len(ID)] == ID:
-                header = 0x200
-        except IndexError:
-            pass
+        verdict = {"header": header, "expanded": False, "repair": None,
+                   "trailing": False, "clean": False, "valid": False}
 
-        try:
-            # Check for a headered LoROM.
-            if ~d[0x81dc] & 0xff == d[0x81de] and \
-               ~d[0x81dd] & 0xff == d[0x81df] and \
-               d[0x101c0:0x101c0 + len(ID)] == ID:
-                header = 0x200
-        except IndexError:
-            pass
+        # Check if the ROM is big enough, then hash it in every way it could
+        # be fixed at once.
+        size = self.seek(0, 2)
+        self.seek(0)
+        if size < 0x300000:
+            return verdict
+        with self.getbuffer() as b:
+            self.fingerprints = fingerprintVariants(b, romVariants(size))
+        for name, digests in sorted(self.fingerprints.items()):
+            print("ROM.identify(): {}: {}".format(name, digests["md5"]))
+
+        # Check if it's expanded; if it is, remove the unused expanded space.
+        current = "full"
+        if size > 0x300000 and \
+           self.fingerprints["exhirom"]["md5"] == EB_MD5:
+            print("ROM.identify(): ROM has unused expanded space.")
+            self.removeExpanded()
+            verdict["expanded"] = True
+            current = "trimmed"
+
+        # Check the MD5 checksum, and try to fix the ROM if it's incorrect.
+        md5Hex = self.fingerprints[current]["md5"]
+        clean = md5Hex == EB_MD5
+        if not clean:
+            if md5Hex in EB_WRONG_MD5:
+                print("ROM.identify(): ROM is a known wrong EarthBound ROM.")
+                if self.applyRepair(md5Hex):
+                    verdict["repair"] = md5Hex
+                    clean = self.checkMD5()
+                else:
+                    verdict["unfixed"] = True
+            else:
+                print("ROM.identify(): ROM is unknown.")
+
+        # If we couldn't fix the ROM, try to remove a 0xff byte at the end.
+        if not clean:
+            with self.getbuffer() as b:
+                if verdict["repair"]:
+                    trailing = self.checkMD5(b, {len(b) - 1: 0})
+                else:
+                    trailing = self.fingerprints[current + "Trailing"]["md5"] \
+                               == EB_MD5
+                if b[len(b) - 1] == 0xFF and trailing:
+                    b[len(b) - 1] = 0
+                    verdict["trailing"] = True
+                    clean = True
+
+        # If that didn't work either, find the blocks which differ from the
+        # clean ROM, and repair them if asked to and the repair pack has them
+        # all.
+        if not clean and repair:
+            blocks = self.repairFromBlocks()
+            if blocks:
+                verdict["blocks"] = blocks
+                clean = self.checkMD5()
+        elif not clean:
+            self.findBadBlocks()
+
+        # Perform a final MD5 check for its validity. If it fails, check if
+        # it's at least an EarthBound ROM.
+        if clean:
+            verdict["clean"] = True
+            verdict["valid"] = True
+            print("ROM.__init__(): Clean EarthBound ROM.")
+        elif self.checkEarthBound():
+            verdict["valid"] = True
+            print("ROM.__init__(): Unclean EarthBound ROM.")
+        else:
+            print("ROM.__init__(): Invalid EarthBound ROM.")
+
+        return verdict
 
+    def replay(self, verdict):
+        """Fixes the ROM the way its verdict says, without checking it again;
+        returns whether or not every fix could be made."""
+
+        if verdict["expanded"]:
+            self.removeExpanded()
+        if verdict["repair"] and not self.applyRepair(verdict["repair"]):
+            return False
+        if verdict["trailing"]:
+            with self.getbuffer() as b:
+                b[len(b) - 1] = 0
+        if verdict.get("blocks") and \
+           not self.repairFromBlocks(verdict["blocks"]):
+            return False
+        print("ROM.replay(): Identified from the cache.")
+        return True
+
+    def checkHeader(self, data=None):
+        """Check to see if the ROM is headered or not."""
+
+        if data is None:
+            with self.getbuffer() as b:
+                return self.checkHeader(b)
+
+        header = checkHeaderData(data)
         if header:
             print("ROM.checkHeader(): ROM is headered.")
         else:
@@ -142,23 +278,20 @@ class ROM(BytesIO):
     def removeHeader(self):
         """Removes the header from the data."""
 
-        newData = bytearray(self.getvalue()[self.header:])
-        self.seek(-0x200, 2)
-        self.truncate()
-        self.seek(0)
-        self.write(newData)
+        with self.getbuffer() as b:
+            size = len(b) - self.header
+            b[:size] = b[self.header:]
+        self.truncate(size)
 
     def checkExpanded(self):
         """Check to see if the ROM is HiROM or ExHiROM."""
 
-        # Get only the first three 0x300000 bytes.
-        d = bytearray(self.getvalue())[:0x300000]
-        for offset, diff in EXHIROM_DIFF.items():
-            d[offset] = diff
-
-        # If the normal area is unmodified, then the expanded area is unused and
-        # can be deleted.
-        if self.checkMD5(d):
+        # Check only the first 0x300000 bytes, as if they were HiROM. If the
+        # normal area is unmodified, then the expanded area is unused and can
+        # be deleted.
+        with self.getbuffer() as b:
+            unused = self.checkMD5(b[:0x300000], EXHIROM_DIFF)
+        if unused:
             print("ROM.checkExpanded(): ROM has unused expanded space.")
             return True
         # Otherwise, the expanded area should not be deleted.
@@ -169,20 +302,22 @@ class ROM(BytesIO):
     def removeExpanded(self):
         """Removes the expanded space."""
 
-        newData = bytearray(self.getvalue())
-        if len(newData) > 0x400000:
-            for offset, diff in EXHIROM_DIFF.items():
-                newData[offset] = diff
+        if self.seek(0, 2) > 0x400000:
+            with self.getbuffer() as b:
+                for offset, diff in EXHIROM_DIFF.items():
+                    b[offset] = diff
         self.truncate(0x300000)
         self.seek(0)
-        self.write(newData[:0x300000])
 
-    def checkMD5(self, data=None):
-        """Check to see if the data matches a known MD5 checksum."""
+    def checkMD5(self, data=None, patches=None):
+        """Check to see if the data matches a known MD5 checksum, optionally
+        with some of its bytes replaced by the {offset: byte} patches."""
+
+        if data is None:
+            with self.getbuffer() as b:
+                return self.checkMD5(b, patches)
 
-        if not data:
-            data = self.getvalue()
-        md5Hex = md5(data).hexdigest()
+        md5Hex = md5Patched(data, patches or {})
         print("ROM.checkMD5(): {}".format(md5Hex))
         if md5Hex == EB_MD5:
             return True
@@ -190,32 +325,75 @@ class ROM(BytesIO):
             return False
 
     def repairROM(self):
-        """Attempts to repair the ROM to a known version of EarthBound."""
+        """Attempts to repair the ROM to a known version of EarthBound; returns
+        the MD5 checksum it was repaired from, if it was."""
 
-        md5Hex = md5(self.getvalue()).hexdigest()
+        with self.getbuffer() as b:
+            md5Hex = md5(b).hexdigest()
         if md5Hex in EB_WRONG_MD5:
             print("ROM.repairROM(): ROM is a known wrong EarthBound ROM.")
-            try:
-                patch = IPSPatch(EB_WRONG_MD5[md5Hex])
-            except IOError:
-                print("ROM.repairROM(): Could not find repair patch file.")
-                return
-            copyROM = self.copy()
-            try:
-                patch.applyToTarget(copyROM)
-            except:
-                print("ROM.repairROM(): Failed to apply repair patch.")
-                return
-            self.seek(0)
-            self.write(copyROM.getvalue())
+            if self.applyRepair(md5Hex):
+                return md5Hex
         else:
             print("ROM.repairROM(): ROM is unknown.")
+        return None
+
+    def findBadBlocks(self):
+        """Finds the blocks in which the ROM differs from the clean ROM, if the
+        block table is there; returns the table."""
+
+        table = loadBlockTable()
+        if table is None:
+            return None
+        with self.getbuffer() as b:
+            self.badBlocks = diffBlocks(b, table)
+        print("ROM.findBadBlocks(): {} blocks differ: {}".format(
+              len(self.badBlocks), ", ".join("{:#x}".format(
+              i * REPAIR_BLOCK_SIZE) for i in self.badBlocks[:16])))
+        return table
+
+    def repairFromBlocks(self, blocks=None):
+        """Finds the blocks in which the ROM differs from the clean ROM, unless
+        they are given, and repairs them from the repair pack if it has them
+        all; returns the blocks repaired, if they were."""
+
+        if blocks is None:
+            table = self.findBadBlocks()
+            blocks = self.badBlocks
+        else:
+            table = loadBlockTable()
+        if table is None:
+            return None
+        with self.getbuffer() as b:
+            if not blocks or len(b) != table[0]:
+                return None
+            if repairBlocks(b, blocks, table, loadRepairPack()):
+                print("ROM.repairFromBlocks(): Repaired from the repair pack.")
+                return blocks
+        return None
+
+    def applyRepair(self, md5Hex):
+        """Applies the repair patch for a known wrong ROM; returns whether or
+        not it was applied."""
+
+        try:
+            patch = IPSPatch(EB_WRONG_MD5[md5Hex])
+        except IOError:
+            print("ROM.applyRepair(): Could not find repair patch file.")
+            return False
+        try:
+            patch.applyToTarget(self)
+        except:
+            print("ROM.applyRepair(): Failed to apply repair patch.")
+            return False
+        return True
 
     def checkEarthBound(self):
         """As a last resort, check if the ROM is named "EARTH BOUND"."""
 
-        d = self.getvalue()
-        if d[0xffc0:0xffcb] == ID:
+        with self.getbuffer() as b:
+            named = b[0xffc0:0xffcb] == ID
+        if named:
             print("ROM.checkEarthBound(): ROM is an EarthBound ROM.")
             return True
         else:
@@ -226,19 +404,382 @@ class ROM(BytesIO):
         """Expands or shrinks the size of the ROM."""
 
         self.truncate(size)
-        b = bytearray(self.getvalue())
-        if len(b) < size:
-            b += bytes([0] * (size - len(b)))
-            self.seek(0)
-            self.write(b)
-
-    def writeToFile(self):
-        """Write the data to the ROM file."""
-
-        d = bytearray(self.getvalue())
-        if len(d) > 0x300000 and d[len(d) - 1] == 0:
-            d[len(d) - 1] = 0xFF  # Fix for Lunar IPS patching.
-        f = open(self.romPath, "wb")
-        f.write(d)
-        f.close()
+        end = self.seek(0, 2)
+        if end < size:
+            self.write(bytes(size - end))
+
+    def writeToFile(self, romPath=None):
+        """Write the data to the ROM file, or to another file."""
+
+        with self.getbuffer() as b, open(romPath or self.romPath, "wb") as f:
+            if len(b) > 0x300000 and b[len(b) - 1] == 0:
+                f.write(b[:len(b) - 1])
+                f.write(b"\xFF")  # Fix for Lunar IPS patching.
+            else:
+                f.write(b)
+
+    def writePatched(self, patch, outPath):
+        """Writes the ROM, as it was loaded, with the patch applied to a new
+        file, leaving the ROM and its file untouched. If the data wasn't fixed
+        while loading, the file is cloned, header included, and only the bytes
+        the patch changes are written; returns how many were."""
+
+        if self.fixed:
+            rom = self.copy()
+            patch.applyToTarget(rom)
+            rom.writeToFile(outPath)
+            return rom.seek(0, 2)
+
+        written = patch.applyToCopy(self.romPath, outPath, self.header)
+        with open(outPath, "r+b") as f:
+            end = f.seek(0, 2)
+            if end - self.header > 0x300000:
+                f.seek(end - 1)
+                if f.read(1) == b"\x00":
+                    f.seek(end - 1)
+                    f.write(b"\xFF")  # Fix for Lunar IPS patching.
+        return written
+
+
+def md5Patched(data, patches):
+    """Returns the MD5 checksum of the data with some of its bytes replaced by
+    the {offset: byte} patches, without copying it."""
+
+    h = md5()
+    i = 0
+    for offset in sorted(patches):
+        if offset < len(data):
+            h.update(data[i:offset])
+            h.update(bytes((patches[offset],)))
+            i = offset + 1
+    h.update(data[i:])
+    return h.hexdigest()
+
+
+class Fingerprint:
+    """The CRC32, MD5 and SHA-1 checksums of some data, computed together."""
+
+    def __init__(self):
+        """Starts the checksums of no data."""
+
+        self.md5 = md5()
+        self.sha1 = sha1()
+        self.crc32 = 0
+
+    def updateCRC32(self, data):
+        """Adds the data to the CRC32 checksum."""
+
+        self.crc32 = zlib.crc32(data, self.crc32)
+
+    def updaters(self):
+        """Returns the functions adding data to each checksum, which can be
+        called at the same time in different threads."""
+
+        return self.md5.update, self.sha1.update, self.updateCRC32
+
+    def copy(self):
+        """Returns a copy of the checksums so far."""
+
+        f = Fingerprint()
+        f.md5 = self.md5.copy()
+        f.sha1 = self.sha1.copy()
+        f.crc32 = self.crc32
+        return f
+
+    def digests(self):
+        """Returns the checksums, as hexadecimal strings."""
+
+        return {"crc32": "{:08x}".format(self.crc32),
+                "md5": self.md5.hexdigest(), "sha1": self.sha1.hexdigest()}
+
+
+def romVariants(size):
+    """Returns the {name: (size, {offset: byte})} variants a ROM of the given
+    size is checked as: as it is, trimmed to HiROM if it's expanded, and each
+    of those with its last byte zeroed."""
+
+    variants = {"full": (size, {}), "fullTrailing": (size, {size - 1: 0})}
+    if size > 0x300000:
+        trimmed = dict(EXHIROM_DIFF) if size > 0x400000 else {}
+        variants["exhirom"] = (0x300000, dict(EXHIROM_DIFF))
+        variants["trimmed"] = (0x300000, trimmed)
+        variants["trimmedTrailing"] = (0x300000, dict(trimmed))
+        variants["trimmedTrailing"][1][0x2fffff] = 0
+    return variants
+
+
+def fingerprintVariants(data, variants):
+    """Returns the checksums of each {name: (size, {offset: byte})} variant of
+    the data, each being the start of the data with some bytes replaced. The
+    data is read once: the variants share checksums up to where they differ,
+    at which point they are copied, and the checksums are computed in
+    parallel threads."""
+
+    global hashPool
+    if hashPool is None:
+        # Only imported when needed, as it is slow to import.
+        from concurrent.futures import ThreadPoolExecutor
+        hashPool = ThreadPoolExecutor(6)
+
+    # Cut the data where variants end, and around the bytes they replace.
+    cuts = {0}
+    for size, patches in variants.values():
+        size = min(size, len(data))
+        cuts.add(size)
+        cuts.update(o + d for o in patches if o < size for d in (0, 1))
+    cuts = sorted(cuts)
+
+    results = {}
+    groups = [(Fingerprint(), list(variants))]
+    for a, b in zip(cuts, cuts[1:]):
+        # Finish the variants which end here, and split the others by what
+        # they contain next.
+        newGroups = []
+        for fingerprint, names in groups:
+            split = {}
+            for name in names:
+                if variants[name][0] <= a:
+                    results[name] = fingerprint.copy().digests()
+                else:
+                    split.setdefault(variants[name][1].get(a), []).append(name)
+            for i, (value, names) in enumerate(sorted(split.items(),
+                                               key=lambda s: s[0] is not None)):
+                f = fingerprint if i == 0 else fingerprint.copy()
+                newGroups.append((f, names, value))
+
+        # Feed the piece to every group, a chunk at a time.
+        groups = []
+        for c in range(a, b, FINGERPRINT_SIZE):
+            chunk = data[c:min(b, c + FINGERPRINT_SIZE)]
+            updates = []
+            for fingerprint, names, value in newGroups:
+                piece = chunk if value is None else bytes((value,))
+                updates += [(u, piece) for u in fingerprint.updaters()]
+            list(hashPool.map(lambda u: u[0](u[1]), updates))
+        groups = [(fingerprint, names) for fingerprint, names, value in
+                  newGroups]
+
+    for fingerprint, names in groups:
+        for name in names:
+            results[name] = fingerprint.copy().digests()
+
+    return results
+
+
+class FileBytes:
+    """The bytes of a file, read on demand where they are indexed, so that
+    checks written for data in memory can look at a file without loading it."""
+
+    def __init__(self, f, offset=0):
+        """Views the file from the given offset on."""
+
+        self.file = f
+        self.offset = offset
+        self.size = max(os.fstat(f.fileno()).st_size - offset, 0)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        """Reads a byte or a slice of the file."""
+
+        if not isinstance(key, slice):
+            if key < 0:
+                key += self.size
+            if not 0 <= key < self.size:
+                raise IndexError("FileBytes index out of range")
+            return self[key:key + 1][0]
+
+        start, stop, step = key.indices(self.size)
+        if stop <= start:
+            return b""
+        self.file.seek(self.offset + start)
+        return self.file.read(stop - start)
+
+
+class LazyROM:
+    """A ROM file which answers what its header, title and size are with small
+    reads, and is only loaded, checked and normalized as a ROM when its data
+    is needed; it can be used as one from then on. Files too small to be ROMs
+    are rejected without being loaded."""
+
+    def __init__(self, romPath, repair=False):
+        """Reads what identifies the ROM from the file. The ROM is loaded to be
+        repaired if asked to, like ROM's."""
+
+        self.rom = None
+        self.romPath = romPath
+        self.repair = repair
+        with open(romPath, "rb") as f:
+            self.header = checkHeaderData(FileBytes(f))
+            data = FileBytes(f, self.header)
+            self.size = len(data)
+            self.title = bytes(data[0xffc0:0xffd5])
+
+    def __getattr__(self, name):
+        """Loads the ROM to get anything else from it."""
+
+        return getattr(self.load(), name)
+
+    def load(self):
+        """Returns the loaded ROM."""
+
+        if self.rom is None:
+            self.rom = ROM(self.romPath, repair=self.repair)
+        return self.rom
+
+    def isEarthBound(self):
+        """Checks if the ROM is named "EARTH BOUND"."""
+
+        return self.title[:len(ID)] == ID
+
+    @property
+    def valid(self):
+        """Whether or not this is an EarthBound ROM. One which is too small is
+        rejected without being loaded; one which isn't named "EARTH BOUND" is
+        still loaded, since known dumps are identified by their checksum."""
+
+        if self.size < 0x300000:
+            return False
+        return self.load().valid
+
+    @property
+    def clean(self):
+        """Whether or not this is (or was repaired to) a clean ROM."""
+
+        return self.valid and self.load().clean
+
+
+class ROMLayout:
+    """Describes how a ROM file maps to its normalized data: the size of the
+    header to skip, the amount of data to keep and the (offset, data) patches
+    to apply on top of it."""
+
+    def __init__(self, header=0, size=None, patches=None):
+        """Creates a new layout."""
+
+        self.header = header
+        self.size = size
+        self.patches = patches or []
+
+
+class ROMFile:
+    """Reads the normalized data of a ROM file on demand, without loading it."""
+
+    def __init__(self, romPath, layout=None, repair=False):
+        """Opens the ROM file, working out its layout if none is given, with its
+        blocks repaired if asked to."""
+
+        if layout is None:
+            layout = detectLayout(romPath, repair)
+        self.romPath = romPath
+        self.layout = layout
+        self.file = open(romPath, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size - layout.header
+        if layout.size is not None:
+            self.size = min(self.size, layout.size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        """Reads a byte or a slice of the normalized data."""
+
+        if not isinstance(key, slice):
+            if key < 0:
+                key += self.size
+            return self[key:key + 1][0]
+
+        start, stop, step = key.indices(self.size)
+        if stop <= start:
+            return b""
+        self.file.seek(self.layout.header + start)
+        data = self.file.read(stop - start)
+        for offset, patch in self.layout.patches:
+            a = max(offset, start)
+            b = min(offset + len(patch), stop)
+            if a < b:
+                data = bytearray(data)
+                data[a - start:b - start] = patch[a - offset:b - offset]
+
+        return data
+
+    def md5(self):
+        """Returns the MD5 checksum of the normalized data."""
+
+        h = md5()
+        for i in range(0, self.size, READ_SIZE):
+            h.update(self[i:i + READ_SIZE])
+        return h.hexdigest()
+
+    def close(self):
+        """Closes the ROM file."""
+
+        self.file.close()
+
+
+def detectHeader(romPath):
+    """Returns the size of a ROM file's header, reading only its start."""
+
+    with open(romPath, "rb") as f:
+        return checkHeaderData(FileBytes(f))
+
+
+def detectLayout(romPath, repair=False):
+    """Works out how ROM.__init__ would normalize a ROM file, reading it a
+    window at a time."""
+
+    header = detectHeader(romPath)
+    size = os.path.getsize(romPath) - header
+    layout = ROMLayout(header, size)
+    if size < 0x300000:
+        return layout
+
+    def checksum(size, patches):
+        with ROMFile(romPath, ROMLayout(header, size, patches)) as rom:
+            return rom.md5()
+
+    # Check if the expanded space is unused; if it is, drop it.
+    exHiROM = [(offset, bytes((diff,))) for offset, diff in
+               EXHIROM_DIFF.items()]
+    if size > 0x300000 and checksum(0x300000, exHiROM) == EB_MD5:
+        layout.size = 0x300000
+        if size > 0x400000:
+            layout.patches = exHiROM
+
+    # Try to repair the ROM to a known version of EarthBound.
+    md5Hex = checksum(layout.size, layout.patches)
+    if md5Hex != EB_MD5 and md5Hex in EB_WRONG_MD5:
+        try:
+            patch = IPSPatch(EB_WRONG_MD5[md5Hex])
+            layout.patches = layout.patches + list(patch.records.items())
+            md5Hex = checksum(layout.size, layout.patches)
+        except IOError:
+            pass
 
+    # If that didn't work, try to remove a 0xff byte at the end.
+    if md5Hex != EB_MD5:
+        with ROMFile(romPath, layout) as rom:
+            last = rom[layout.size - 1]
+        patches = layout.patches + [(layout.size - 1, b"\x00")]
+        if last == 0xFF and checksum(layout.size, patches) == EB_MD5:
+            layout.patches = patches
+            md5Hex = EB_MD5
+
+    # If that didn't work either, repair the blocks which differ from the
+    # clean ROM from the repair pack, like ROM.repairFromBlocks, if asked to.
+    table = loadBlockTable() if md5Hex != EB_MD5 and repair else None
+    if table is not None and layout.size == table[0]:
+        with ROMFile(romPath, layout) as rom:
+            blocks = diffBlocks(rom, table)
+        patches = repairPatches(blocks, table, loadRepairPack())
+        if blocks and patches is not None:
+            layout.patches = layout.patches + patches
+
+    return layout
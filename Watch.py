@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+"""
+    EarthBound Patcher - An easy-to-use EarthBound ROM patcher.
+    Copyright (C) 2013  Lyrositor <gagne.marc@gmail.com>
+
+    This file is part of EarthBound Patcher.
+
+    EarthBound Patcher is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    EarthBound Patcher is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with EarthBound Patcher.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Watch
+# Regenerates an EBP patch every time the hacked ROM is saved.
+
+import argparse
+import ctypes
+import ctypes.util
+from hashlib import blake2b
+import json
+import os
+import select
+import struct
+import sys
+import time
+
+from Diff import *
+from EBPPatch import *
+from ROM import *
+
+# The inotify events which mean that a file has been written or replaced.
+IN_CLOSE_WRITE = 0x08
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+
+# How long a file must stay untouched before it is considered saved.
+SETTLE_TIME = 0.25
+
+
+class FileWatcher:
+    """Waits for a file to change, using inotify where it is available and
+    polling the file otherwise."""
+
+    def __init__(self, path, interval=0.5):
+        """Starts watching the file."""
+
+        self.path = os.path.abspath(path)
+        self.interval = interval
+        self.fd = None
+        self.state = self.stat()
+
+        # Watch the directory, since editors and compilers often replace the
+        # file instead of writing to it.
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init()
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init failed")
+            mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+            directory = os.fsencode(os.path.dirname(self.path))
+            if libc.inotify_add_watch(fd, directory, mask) < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+            self.fd = fd
+            print("FileWatcher.__init__(): Watching with inotify.")
+        except (AttributeError, OSError, TypeError):
+            print("FileWatcher.__init__(): Watching by polling.")
+
+    def stat(self):
+        """Returns what identifies the current version of the file."""
+
+        try:
+            s = os.stat(self.path)
+        except OSError:
+            return None
+        return (s.st_size, s.st_mtime_ns, s.st_ino)
+
+    def wait(self):
+        """Blocks until the file has changed and settled."""
+
+        while True:
+            if self.fd is not None:
+                self.waitForEvent(None)
+            else:
+                time.sleep(self.interval)
+
+            # Let the writer finish before reporting the change.
+            while self.waitForEvent(SETTLE_TIME):
+                pass
+            state = self.stat()
+            if state is not None and state != self.state:
+                self.state = state
+                return
+
+    def waitForEvent(self, timeout):
+        """Waits for an event concerning the file; returns whether or not one
+        happened before the timeout."""
+
+        if self.fd is None:
+            state = self.stat()
+            time.sleep(timeout)
+            return state != self.stat()
+
+        name = os.fsencode(os.path.basename(self.path))
+        found = False
+        while select.select([self.fd], [], [], timeout)[0]:
+            data = os.read(self.fd, 0x1000)
+            i = 0
+            while i < len(data):
+                wd, mask, cookie, size = struct.unpack_from("iIII", data, i)
+                i += 16
+                if data[i:i + size].rstrip(b"\x00") == name:
+                    found = True
+                i += size
+
+            # Read whatever else is already waiting.
+            timeout = 0
+        return found
+
+    def close(self):
+        """Stops watching the file."""
+
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class PatchWatcher:
+    """Keeps an EBP patch up to date with a hacked ROM, re-diffing only the
+    banks which changed since the previous build."""
+
+    def __init__(self, cleanROM, hackedPath, patchPath, metadata,
+                 optimize=False):
+        """Prepares to build patches against the clean ROM."""
+
+        self.source = cleanROM.getvalue()
+        self.hackedPath = hackedPath
+        self.patchPath = patchPath
+        self.metadata = metadata
+        self.optimize = optimize
+
+        # The manifest of the previous build: each bank's hash and runs.
+        self.hashes = []
+        self.bankRuns = []
+
+    def rebuild(self):
+        """Rebuilds the patch from the hacked ROM; returns the number of banks
+        which had to be diffed again."""
+
+        target = ROM(self.hackedPath).getvalue()
+        banks = (len(target) + BLOCK_SIZE - 1) // BLOCK_SIZE
+        del self.hashes[banks:]
+        del self.bankRuns[banks:]
+
+        # Diff the banks which changed, and splice their runs into the rest.
+        changed = 0
+        view = memoryview(target)
+        for bank in range(banks):
+            start = bank * BLOCK_SIZE
+            h = blake2b(view[start:start + BLOCK_SIZE], digest_size=16).digest()
+            if bank < len(self.hashes) and self.hashes[bank] == h:
+                continue
+            runs = findRuns(self.source, target, start, start + BLOCK_SIZE,
+                            padded=self.optimize)
+            if bank < len(self.hashes):
+                self.hashes[bank] = h
+                self.bankRuns[bank] = runs
+            else:
+                self.hashes.append(h)
+                self.bankRuns.append(runs)
+            changed += 1
+        view.release()
+
+        if changed:
+            runs = []
+            for bankRuns in self.bankRuns:
+                for start, end in bankRuns:
+                    addRun(runs, start, end)
+            records = makeRecords(runs, target, len(self.source),
+                                  self.optimize)
+
+            # Replace the patch in one go so that nothing reads it half-written.
+            patch = EBPPatch(self.patchPath, True)
+            with open(self.patchPath + ".tmp", "wb") as f:
+                patch.writePatch(f, records, target, self.metadata,
+                                 self.optimize)
+            os.replace(self.patchPath + ".tmp", self.patchPath)
+
+        return changed
+
+    def run(self, fileWatcher=None):
+        """Builds the patch, then rebuilds it every time the hacked ROM is
+        saved, until interrupted."""
+
+        if fileWatcher is None:
+            fileWatcher = FileWatcher(self.hackedPath)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    changed = self.rebuild()
+                    sys.stderr.write("Rebuilt {} ({} banks changed) in {:.1f} "
+                                     "ms.\n".format(self.patchPath, changed,
+                                     (time.perf_counter() - start) * 1000))
+                except (IOError, IndexError):
+                    sys.stderr.write("Could not rebuild {}.\n".format(
+                                     self.patchPath))
+                fileWatcher.wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            fileWatcher.close()
+
+
+########
+# MAIN #
+########
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuilds an EBP patch every "
+                                     "time the hacked ROM is saved.")
+    parser.add_argument("clean", help="the clean EarthBound ROM")
+    parser.add_argument("hacked", help="the hacked ROM to watch")
+    parser.add_argument("patch", help="the EBP patch to write")
+    parser.add_argument("--title", default="")
+    parser.add_argument("--author", default="")
+    parser.add_argument("--description", default="")
+    parser.add_argument("--optimize", action="store_true",
+                        help="make the patch as small as possible")
+    args = parser.parse_args()
+
+    sys.stdout = open(os.devnull, "w")
+    cleanROM = ROM(args.clean, repair=True)
+    if not cleanROM.clean:
+        sys.exit("The clean ROM must be a known clean ROM.")
+    metadata = json.dumps({"patcher": "EBPatcher", "author": args.author,
+                           "title": args.title,
+                           "description": args.description})
+    PatchWatcher(cleanROM, args.hacked, args.patch, metadata,
+                 args.optimize).run()
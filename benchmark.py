@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+"""
+    EarthBound Patcher - An easy-to-use EarthBound ROM patcher.
+    Copyright (C) 2013  Lyrositor <gagne.marc@gmail.com>
+
+    This file is part of EarthBound Patcher.
+
+    EarthBound Patcher is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    EarthBound Patcher is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with EarthBound Patcher.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Benchmarks
+# Measures the patcher's performance on synthetic ROMs and patches.
+
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from IPSPatch import *
+from ROM import *
+
+# The number of times each measurement is repeated; the best time is kept.
+REPEAT = 5
+
+# Where the results go, since the patcher's own messages are silenced.
+output = sys.stdout
+
+
+def report(line=""):
+    """Writes a line of results."""
+
+    output.write(line + "\n")
+
+
+def best(function):
+    """Returns the best time, in milliseconds, taken by the function."""
+
+    times = []
+    for i in range(REPEAT):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+
+def makePatch(path, romSize, patchSize, seed=0):
+    """Writes an IPS patch changing patchSize bytes spread over the ROM, half
+    of them in literal records and half in RLE records."""
+
+    rng = random.Random(seed)
+    records = max(patchSize // 0x400, 1)
+    size = max(patchSize // records, 2)
+    with open(path, "wb") as f:
+        f.write(b"PATCH")
+        for i in range(records):
+            offset = i * (romSize // records)
+            f.write(offset.to_bytes(3, "big"))
+            f.write((size // 2).to_bytes(2, "big"))
+            f.write(bytes(rng.getrandbits(8) for j in range(size // 2)))
+            f.write((offset + size // 2).to_bytes(3, "big"))
+            f.write(b"\x00\x00" + (size // 2).to_bytes(2, "big") + b"\xFF")
+        f.write(b"EOF")
+
+
+def benchLoad(directory):
+    """Shows how long loading a ROM takes, and how much memory is allocated at
+    most, as a multiple of the ROM's size; more than one ROM's worth means its
+    data was copied."""
+
+    report("Loading ROMs:")
+    report("{:>10} {:>10} {:>10} {:>10}".format("ROM", "header", "ms", "peak"))
+    romPath = os.path.join(directory, "bench.smc")
+    for romSize in (0x300000, 0x600000):
+        for header in (0, 0x200):
+            with open(romPath, "wb") as f:
+                f.write(os.urandom(header + romSize))
+            t = best(lambda: ROM(romPath))
+            tracemalloc.start()
+            ROM(romPath)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            report("{:>10x} {:>10x} {:>10.3f} {:>10.2f}".format(
+                   romSize, header, t, peak / romSize))
+    report()
+
+
+def benchApply(directory):
+    """Shows how the cost of applying a patch scales with the patch's size and
+    with the ROM's size."""
+
+    report("Applying patches (ms):")
+    report("{:>10} {:>10} {:>10}".format("ROM", "patch", "apply"))
+    romPath = os.path.join(directory, "bench.smc")
+    patchPath = os.path.join(directory, "bench.ips")
+    for romSize in (0x300000, 0x600000):
+        with open(romPath, "wb") as f:
+            f.write(os.urandom(romSize))
+        rom = ROM(romPath)
+        for patchSize in (0x400, 0x4000, 0x40000, 0x100000):
+            makePatch(patchPath, romSize, patchSize)
+            patch = IPSPatch(patchPath)
+            target = rom.copy()
+            target.getbuffer().release()
+            t = best(lambda: patch.applyToTarget(target))
+            report("{:>10x} {:>10x} {:>10.3f}".format(romSize, patchSize, t))
+    report()
+
+
+########
+# MAIN #
+########
+
+if __name__ == "__main__":
+    sys.stdout = open(os.devnull, "w")
+    with tempfile.TemporaryDirectory() as directory:
+        for bench in (benchLoad, benchApply):
+            bench(directory)
@@ -41,4 +41,6 @@ setup(name = "EBPatcher",
       options = {"build_exe": build_exe_options},
       executables = [Executable("EBPatcher.py", base=base,
 								icon="res/EBPatcher_Icon.ico",
-								shortcutName="EarthBound Patcher")])
+								shortcutName="EarthBound Patcher"),
+					 Executable("EBPatcherCLI.py",
+								icon="res/EBPatcher_Icon.ico")])
@@ -1,17 +1,38 @@
 #!/usr/bin/env python3
 
 import array
+import io
+import os
+import random
+import tempfile
+import threading
+import tracemalloc
 import unittest
+from io import BytesIO
 from os import listdir, remove, chdir
 from os.path import isfile, join
 from shutil import copyfile
-from hashlib import sha256
+from hashlib import md5, sha1, sha256
+import zlib
 
 import sys
 sys.path.append('../')
 
+import Batch
+import BlockDB
+from BlockDB import *
+from Compatibility import *
+from Diff import *
 from EBPPatch import *
+import EBPatcherCLI
+from HackStore import *
+from PatchAnalysis import *
+from PatchStack import *
 from ROM import *
+from Watch import *
+
+METADATA = json.dumps({"patcher": "EBPatcher", "author": "x", "title": "y",
+                       "description": "z"})
 
 def isRomFilename(fname):
     return fname.lower().endswith(".smc") or fname.lower().endswith(".sfc")
@@ -22,6 +43,50 @@ def checksumOfFile(fname):
 def checksumOfRom(rom):
     return sha256(rom.getvalue()).hexdigest()
 
+class TrickleIO(BytesIO):
+    """A stream which, like a pipe, returns fewer bytes than asked for."""
+    def readinto(self, b):
+        return super().readinto(memoryview(b)[:7])
+
+def legacyRecords(source, target):
+    """The original byte-by-byte record creation, used as a reference."""
+    i = None
+    records = {}
+    for p in range(len(target)):
+        t = target[p:p + 1]
+        if t == source[p:p + 1]:
+            i = None
+            continue
+        if i is not None and p - i == 0xFFFF:
+            i = None
+        if i is None:
+            i = p
+            records[i] = t
+        else:
+            records[i] += t
+    return [(r, len(records[r]), None) for r in sorted(records)]
+
+def randomRomData(size, seed):
+    """Builds a pseudo-random source and a target with scattered edits."""
+    rng = random.Random(seed)
+    source = bytearray(rng.getrandbits(8) for _ in range(size))
+    target = bytearray(source)
+    for _ in range(200):
+        start = rng.randrange(size)
+        for p in range(start, min(size, start + rng.randrange(1, 40))):
+            target[p] = rng.getrandbits(8)
+    # A run longer than a single record, crossing a bank boundary.
+    for p in range(0x8000, 0x22000):
+        target[p] = source[p] ^ 0xFF
+    return bytes(source), bytes(target)
+
+def addHeader(data):
+    """Marks the data as an EarthBound HiROM and puts a copier header on it."""
+    data = bytearray(data)
+    data[0xffc0:0xffc0 + len(ID)] = ID
+    data[0xffdc:0xffe0] = b"\x12\x34\xed\xcb"
+    return bytes(0x200) + bytes(data)
+
 class testEbp(unittest.TestCase):
     """
     A test class to test the creation and application of EBP patches
@@ -114,11 +179,803 @@ class testEbp(unittest.TestCase):
                 print(cleanRom.romPath, "(", inputChecksum[:5], ") *",
                         modifiedRom.romPath, "=", outputChecksum[:5])
                 self.assertEqual(inputChecksum, outputChecksum)
+
+
+class testDiff(unittest.TestCase):
+    """
+    A test class to test the diff engine against synthetic ROM data
+    """
+
+    TMP_ROM_FNAME = "/tmp/tmp_diff.smc"
+    TMP_EBP_FNAME = "/tmp/tmp_diff.ebp"
+    TMP_HACK_FNAME = "/tmp/tmp_diff_hack.smc"
+
+    def tearDown(self):
+        for fname in (self.TMP_EBP_FNAME, self.TMP_ROM_FNAME,
+                      self.TMP_HACK_FNAME):
+            if isfile(fname):
+                remove(fname)
+
+    def applyPatch(self, source, patchClass=EBPPatch):
+        """Applies the temporary patch to the source, returning the result."""
+        with open(self.TMP_ROM_FNAME, "wb") as f:
+            f.write(source)
+        rom = ROM(self.TMP_ROM_FNAME)
+        patchClass(self.TMP_EBP_FNAME).applyToTarget(rom)
+        return rom.getvalue()
+
+    def runCommandLine(self, *argv):
+        """Runs the command line, returning its status and output."""
+        stdout = sys.stdout
+        sys.stdout = io.TextIOWrapper(BytesIO(), write_through=True)
+        try:
+            status = EBPatcherCLI.main(list(argv))
+            return status, sys.stdout.buffer.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def testRecordsMatchLegacy(self):
+        """
+        Test that the block diff produces exactly the records of the original
+        byte-by-byte comparison, including a longer target.
+        """
+        source, target = randomRomData(0x30000, 1)
+        target += bytes(0x1234)
+        self.assertEqual(splitRuns(findRuns(source, target)),
+                         legacyRecords(source, target))
+
+    def testParallelRunsMatchSerial(self):
+        """
+        Test that diffing the banks in parallel gives the same runs as a serial
+        diff, whatever the number of workers.
+        """
+        source, target = randomRomData(0x60000, 3)
+        target += b"\xFF" * 0x10
+        serial = findRuns(source, target)
+        for workers in (1, 3):
+            self.assertEqual(findRunsParallel(source, target, workers), serial)
+
+    def testStreamingPatchMatchesInMemory(self):
+        """
+        Test that creating a patch from the ROM files gives the same patch as
+        loading both ROMs, with and without optimization.
+        """
+        source, target = randomRomData(0x40000, 4)
+        with open(self.TMP_ROM_FNAME, "wb") as f:
+            f.write(source)
+        with open(self.TMP_HACK_FNAME, "wb") as f:
+            f.write(addHeader(target + b"\xFF" * 0x20000))
+        sourceROM = ROM(self.TMP_ROM_FNAME)
+        targetROM = ROM(self.TMP_HACK_FNAME)
+        self.assertEqual(targetROM.header, 0x200)
+
+        for optimize in (False, True):
+            patch = EBPPatch(self.TMP_EBP_FNAME, new=True)
+            patch.createFromSource(sourceROM, targetROM, METADATA, optimize)
+            patch.createFromFiles(self.TMP_ROM_FNAME, self.TMP_HACK_FNAME,
+                                  METADATA, optimize=optimize)
+            self.assertEqual(checksumOfFile(self.TMP_EBP_FNAME),
+                             sha256(patch.getvalue()).hexdigest())
+
+    def testWatcherRebuildsChangedBanks(self):
+        """
+        Test that the watcher only diffs the banks which changed, and still
+        writes the same patch as a full creation.
+        """
+        source, target = randomRomData(0x40000, 5)
+        with open(self.TMP_ROM_FNAME, "wb") as f:
+            f.write(source)
+        with open(self.TMP_HACK_FNAME, "wb") as f:
+            f.write(target)
+        watcher = PatchWatcher(ROM(self.TMP_ROM_FNAME), self.TMP_HACK_FNAME,
+                               self.TMP_EBP_FNAME, METADATA)
+        self.assertEqual(watcher.rebuild(), 4)
+
+        target = bytearray(target)
+        target[0x31000] ^= 0xFF
+        with open(self.TMP_HACK_FNAME, "wb") as f:
+            f.write(target)
+        self.assertEqual(watcher.rebuild(), 1)
+        checksum = checksumOfFile(self.TMP_EBP_FNAME)
+        patch = EBPPatch(self.TMP_EBP_FNAME, new=True)
+        patch.createFromSource(BytesIO(source), BytesIO(target), METADATA)
+        self.assertEqual(checksum, sha256(patch.getvalue()).hexdigest())
+
+    def testBatchJobs(self):
+        """
+        Test that a batch job writes the same patch as a single creation, with
+        the shared metadata merged with that of the ROM.
+        """
+        rng = random.Random(13)
+        source = bytearray(rng.randbytes(0x300000))
+        source[0xffc0:0xffc0 + len(ID)] = ID
+        target = bytearray(source)
+        target[0x1234:0x1240] = bytes(12)
+        target[0x2FFFF0:] = rng.randbytes(0x10)
+        with tempfile.TemporaryDirectory() as root:
+            hackedPath = os.path.join(root, "hack.sfc")
+            with open(hackedPath, "wb") as f:
+                f.write(target)
+            with open(os.path.join(root, "hack.json"), "w") as f:
+                json.dump({"description": "d", "patcher": "other"}, f)
+            metadata = Batch.jobMetadata(hackedPath, {"author": "a",
+                                                      "description": "x"})
+            self.assertEqual(json.loads(metadata), {
+                             "patcher": "EBPatcher", "author": "a",
+                             "description": "d", "title": "hack"})
+
+            cleanData = Batch.cleanData
+            Batch.cleanData = (None, memoryview(bytes(source)))
+            try:
+                size, seconds = Batch.createPatchJob(hackedPath,
+                                self.TMP_EBP_FNAME, metadata, False)
+            finally:
+                Batch.cleanData = cleanData
+        self.assertIsNone(Batch.cleanData)
+        self.assertEqual(size, len(target))
+        checksum = checksumOfFile(self.TMP_EBP_FNAME)
+        patch = EBPPatch(self.TMP_EBP_FNAME, new=True)
+        patch.createFromSource(BytesIO(source), BytesIO(target), metadata)
+        self.assertEqual(checksum, sha256(patch.getvalue()).hexdigest())
+
+    def testProgressAndCancellation(self):
+        """
+        Test that the diff reports its progress up to the full size, and stops
+        when it is cancelled.
+        """
+        source, target = randomRomData(0x30000, 6)
+        reports = []
+        findRuns(source, target, progress=lambda s, t: reports.append((s, t)))
+        self.assertEqual(reports[-1], (0x30000, 0x30000))
+
+        cancel = threading.Event()
+        cancel.set()
+        patch = EBPPatch(self.TMP_EBP_FNAME, new=True)
+        with self.assertRaises(PatchCancelled):
+            patch.createFromSource(BytesIO(source), BytesIO(target), METADATA,
+                                   cancel=cancel)
+        self.assertFalse(isfile(self.TMP_EBP_FNAME))
+
+    def testOptimizedPatchAppliesCorrectly(self):
+        """
+        Test that an optimized patch is smaller than a plain one and still
+        turns the source into the target.
+        """
+        source, target = randomRomData(0x30000, 2)
+        target = bytearray(target)
+        target[0x24000:0x26000] = bytes(0x2000)
+        target[0x27000:0x27100] = b"\xFF" * 0x100
+        target[0x28000:0x28010] = b"\x01\x02" + b"\x00" * 12 + b"\x03\x04"
+        target = bytes(target) + bytes(0x8000) + b"\xFF" * 0x8000 + bytes(0x10)
+
+        sizes = []
+        for optimize in (False, True):
+            patch = EBPPatch(self.TMP_EBP_FNAME, new=True)
+            patch.createFromSource(BytesIO(source), BytesIO(target), METADATA,
+                                   optimize)
+            sizes.append(len(patch.getvalue()))
+        self.assertLess(sizes[1], sizes[0])
+        self.assertEqual(self.applyPatch(source), target)
+
+    def testRecordTableKeepsRLESymbolic(self):
+        """
+        Test that RLE records are kept as a value and a count, and literal
+        records as views of the patch.
+        """
+        with open(self.TMP_EBP_FNAME, "wb") as f:
+            f.write(b"PATCH\x00\x00\x04\x00\x00\x01\x00\xAA"
+                    b"\x00\x00\x02\x00\x02xyEOF")
+        patch = IPSPatch(self.TMP_EBP_FNAME)
+        self.assertEqual(list(patch.records),
+                         [(4, 0x100, RLE, 0xAA), (2, 2, LITERAL, 18)])
+        self.assertIsInstance(patch.records.data(2, LITERAL, 18), memoryview)
+        self.assertEqual(self.applyPatch(bytes(0x200), IPSPatch),
+                         b"\x00\x00xy" + b"\xAA" * 0x100 + bytes(0xFC))
+
+    def testApplyInPlace(self):
+        """
+        Test that patching a headered ROM file in place keeps its header, and
+        only writes what changes.
+        """
+        source, target = randomRomData(0x30000, 8)
+        source = addHeader(source)[0x200:]
+        target = addHeader(target)[0x200:]
+        patch = EBPPatch(self.TMP_EBP_FNAME, new=True)
+        patch.createFromSource(BytesIO(source), BytesIO(target), METADATA)
+        with open(self.TMP_ROM_FNAME, "wb") as f:
+            f.write(addHeader(source))
+        patch = EBPPatch(self.TMP_EBP_FNAME)
+        header = detectHeader(self.TMP_ROM_FNAME)
+        self.assertEqual(header, 0x200)
+
+        self.assertGreater(patch.applyToFile(self.TMP_ROM_FNAME, header), 0)
+        self.assertEqual(open(self.TMP_ROM_FNAME, "rb").read(),
+                         addHeader(target))
+        self.assertEqual(patch.applyToFile(self.TMP_ROM_FNAME, header), 0)
+
+        # Records past the end of the file extend it.
+        with open(self.TMP_EBP_FNAME, "wb") as f:
+            f.write(b"PATCH\x04\x00\x00\x00\x01zEOF")
+        IPSPatch(self.TMP_EBP_FNAME).applyToFile(self.TMP_ROM_FNAME, header)
+        self.assertEqual(open(self.TMP_ROM_FNAME, "rb").read(),
+                         addHeader(target) + bytes(0x10000) + b"z")
+
+    def testPatchedCopy(self):
+        """
+        Test that patching into a new file leaves the ROM file untouched, and
+        gives the same result as patching it in place.
+        """
+        source, target = randomRomData(0x30000, 9)
+        source = addHeader(source)[0x200:]
+        target = addHeader(target)[0x200:]
+        patch = EBPPatch(self.TMP_EBP_FNAME, new=True)
+        patch.createFromSource(BytesIO(source), BytesIO(target), METADATA)
+        with open(self.TMP_ROM_FNAME, "wb") as f:
+            f.write(addHeader(source))
+        patch = EBPPatch(self.TMP_EBP_FNAME)
+        rom = ROM(self.TMP_ROM_FNAME)
+        self.assertFalse(rom.fixed)
+
+        self.assertGreater(rom.writePatched(patch, self.TMP_HACK_FNAME), 0)
+        self.assertEqual(open(self.TMP_HACK_FNAME, "rb").read(),
+                         addHeader(target))
+        self.assertEqual(open(self.TMP_ROM_FNAME, "rb").read(),
+                         addHeader(source))
+        self.assertIn(cloneFile(self.TMP_ROM_FNAME, self.TMP_HACK_FNAME),
+                      ("clone", "range", "copy"))
+        self.assertEqual(open(self.TMP_HACK_FNAME, "rb").read(),
+                         addHeader(source))
+
+        # Writing over the ROM file itself patches it in place.
+        with self.assertRaises(ValueError):
+            cloneFile(self.TMP_ROM_FNAME, self.TMP_ROM_FNAME)
+        self.assertGreater(rom.writePatched(patch, self.TMP_ROM_FNAME), 0)
+        self.assertEqual(open(self.TMP_ROM_FNAME, "rb").read(),
+                         addHeader(target))
+
+    def testHackStore(self):
+        """
+        Test that stored patches are built into ROMs in memory, and that only
+        the most recently used ROMs are kept.
+        """
+        source, target = randomRomData(0x30000, 10)
+        patch = EBPPatch(self.TMP_EBP_FNAME, new=True)
+        patch.createFromSource(BytesIO(source), BytesIO(target), METADATA)
+        with open(self.TMP_ROM_FNAME, "wb") as f:
+            f.write(source)
+        with tempfile.TemporaryDirectory() as root:
+            store = HackStore(root, cacheSize=0x30000)
+            store.cleanROM = ROM(self.TMP_ROM_FNAME)
+            hashHex = store.add(self.TMP_EBP_FNAME)
+            self.assertEqual(hashHex, checksumOfFile(self.TMP_EBP_FNAME))
+            self.assertIn(hashHex, store)
+            self.assertEqual(store.hashes(), [hashHex])
+
+            rom = store.get(hashHex)
+            self.assertEqual(rom.getvalue(), target)
+            self.assertIs(store.get(hashHex), rom)
+            self.assertEqual(store.cleanROM.getvalue(), source)
+
+            with open(self.TMP_EBP_FNAME, "wb") as f:
+                f.write(b"PATCH\x00\x00\x00\x00\x01\xAAEOF")
+            other = store.add(self.TMP_EBP_FNAME)
+            self.assertEqual(store.get(other).getvalue()[:2], b"\xAA" + source[1:2])
+            self.assertEqual(list(store.materialized), [other])
+            with self.assertRaises(KeyError):
+                store.get("0" * 64)
+
+    def testCommandLine(self):
+        """
+        Test that the command line creates patches and applies them to files
+        and through pipes, and that it doesn't load the GUI.
+        """
+        source, target = randomRomData(0x30000, 11)
+        with open(self.TMP_ROM_FNAME, "wb") as f:
+            f.write(source)
+        with open(self.TMP_HACK_FNAME, "wb") as f:
+            f.write(target)
+
+        run = self.runCommandLine
+        self.assertEqual(run("--no-cache", "create", self.TMP_ROM_FNAME,
+                             self.TMP_HACK_FNAME), (1, b""))
+        clean = LazyROM.clean
+        LazyROM.clean = True
+        try:
+            status, patch = run("--no-cache", "create", self.TMP_ROM_FNAME,
+                                self.TMP_HACK_FNAME, "--title", "y")
+        finally:
+            LazyROM.clean = clean
+        self.assertEqual(status, 0)
+        with open(self.TMP_EBP_FNAME, "wb") as f:
+            f.write(patch)
+        status, info = run("info", self.TMP_EBP_FNAME)
+        self.assertIn(b"Title: y", info)
+
+        status, patched = run("apply", self.TMP_EBP_FNAME, self.TMP_ROM_FNAME,
+                              "-o", "-")
+        self.assertEqual(patched, target)
+        self.assertEqual(run("apply", self.TMP_EBP_FNAME, self.TMP_ROM_FNAME),
+                         (0, b""))
+        self.assertEqual(open(self.TMP_ROM_FNAME, "rb").read(), target)
+
+        # An output which is the ROM itself, under another name, is patched in
+        # place.
+        with open(self.TMP_ROM_FNAME, "wb") as f:
+            f.write(source)
+        alias = os.path.join(os.path.dirname(self.TMP_ROM_FNAME), ".",
+                             os.path.basename(self.TMP_ROM_FNAME))
+        stdin = sys.stdin
+        sys.stdin = open(self.TMP_EBP_FNAME, "rb")
+        try:
+            self.assertEqual(run("apply", "-", self.TMP_ROM_FNAME, "-o",
+                                 alias), (0, b""))
+        finally:
+            sys.stdin.close()
+            sys.stdin = stdin
+        self.assertEqual(open(self.TMP_ROM_FNAME, "rb").read(), target)
+        self.assertEqual(run("apply", "missing.ebp", self.TMP_ROM_FNAME)[0], 1)
+        self.assertEqual(run("--no-cache", "identify",
+                             self.TMP_ROM_FNAME)[0], 1)
+        self.assertNotIn("PyQt5", sys.modules)
+
+    def testCommandLineNormalizesROMs(self):
+        """
+        Test that the command line applies patches to ROMs as they are loaded,
+        like the GUI, writing the whole ROM if it had to be fixed.
+        """
+        rng = random.Random(19)
+        clean = bytearray(addHeader(rng.randbytes(0x300000))[0x200:])
+        for offset, diff in EXHIROM_DIFF.items():
+            clean[offset] = diff
+        target = bytearray(clean)
+        target[0x1234:0x1240] = bytes(12)
+        expanded = bytearray(clean) + b"\xFF" * 0x300000
+        expanded[0xffd5] = 0x25
+        expanded[0xffd7] = 0x0d
+        patch = EBPPatch(self.TMP_EBP_FNAME, new=True)
+        patch.createFromSource(BytesIO(clean), BytesIO(target), METADATA,
+                               optimize=True)
+
+        module = sys.modules[ROM.__module__]
+        cleanMD5 = module.EB_MD5
+        module.EB_MD5 = md5(clean).hexdigest()
+        try:
+            with open(self.TMP_ROM_FNAME, "wb") as f:
+                f.write(expanded)
+            self.assertEqual(self.runCommandLine("--no-cache", "apply",
+                             self.TMP_EBP_FNAME, self.TMP_ROM_FNAME, "-o",
+                             self.TMP_HACK_FNAME), (0, b""))
+            self.assertEqual(open(self.TMP_HACK_FNAME, "rb").read(), target)
+            self.assertEqual(self.runCommandLine("--no-cache", "apply",
+                             self.TMP_EBP_FNAME, self.TMP_ROM_FNAME, "-o",
+                             "-"), (0, target))
+            self.assertEqual(self.runCommandLine("--no-cache", "apply",
+                             self.TMP_EBP_FNAME, self.TMP_ROM_FNAME), (0, b""))
+            self.assertEqual(open(self.TMP_ROM_FNAME, "rb").read(), target)
+
+            # A ROM which didn't need fixing keeps its header.
+            with open(self.TMP_ROM_FNAME, "wb") as f:
+                f.write(addHeader(clean))
+            self.assertEqual(self.runCommandLine("--no-cache", "apply",
+                             self.TMP_EBP_FNAME, self.TMP_ROM_FNAME), (0, b""))
+            self.assertEqual(open(self.TMP_ROM_FNAME, "rb").read(),
+                             addHeader(target))
+        finally:
+            module.EB_MD5 = cleanMD5
+
+    def testPatchesResizeTheROM(self):
+        """
+        Test that optimized patches shrink the ROM to the target's size, and
+        that IPS patches can truncate it.
+        """
+        source, target = randomRomData(0x30000, 7)
+        patch = EBPPatch(self.TMP_EBP_FNAME, new=True)
+        patch.createFromSource(BytesIO(source), BytesIO(target[:0x20000]),
+                               METADATA, optimize=True)
+        self.assertEqual(self.applyPatch(source), target[:0x20000])
+
+        with open(self.TMP_EBP_FNAME, "wb") as f:
+            f.write(b"PATCH\x00\x00\x10\x00\x02abEOF\x00\x01\x00")
+        self.assertEqual(self.applyPatch(source, IPSPatch),
+                         source[:0x10] + b"ab" + source[0x12:0x100])
+
+    def testPatchesWithoutRecords(self):
+        """
+        Test that patches which only resize the ROM apply, and that records
+        past the end of the ROM extend it when there is no size.
+        """
+        source, target = randomRomData(0x30000, 12)
+        with open(self.TMP_EBP_FNAME, "wb") as f:
+            f.write(b"PATCHEOF\x00\x01\x00")
+        self.assertEqual(self.applyPatch(source, IPSPatch), source[:0x100])
+
+        patch = EBPPatch(self.TMP_EBP_FNAME, new=True)
+        patch.createFromSource(BytesIO(source), BytesIO(source[:0x20000]),
+                               METADATA, optimize=True)
+        self.assertEqual(self.applyPatch(source), source[:0x20000])
+
+        with open(self.TMP_EBP_FNAME, "wb") as f:
+            f.write(b"PATCH\x10\x00\x00\x00\x01zEOF")
+        self.assertEqual(self.applyPatch(source[:0x100], IPSPatch),
+                         source[:0x100] + bytes(0xFFF00) + b"z")
+
+    def testPreflightFindsConflicts(self):
+        """
+        Test that the pre-flight report finds overlapping records, records in
+        the header and past the largest ROM, and the final size.
+        """
+        with open(self.TMP_EBP_FNAME, "wb") as f:
+            f.write(b"PATCH\x00\x03\x00\x00\x04abcd\x00\x03\x02\x00\x04efgh"
+                    b"\x00\x00\x10\x00\x00\x00\x02\x00\x60\x03\x00\x00\x01z"
+                    b"\x40\x00\x00\x00\x02xyEOF")
+        patch = IPSPatch(self.TMP_EBP_FNAME)
+        patch.header = 0x200
+        report = analyzePatch(patch)
+        self.assertEqual(report.overlaps, [(0, 1, 0x102, 0x104)])
+        self.assertEqual(report.writeSet, [(-0x1F0, -0x1EE), (0x100, 0x106),
+                                           (0x3FFE00, 0x3FFE02),
+                                           (0x600100, 0x600101)])
+        self.assertEqual(report.written, 11)
+        self.assertEqual(report.finalSize, 0x600101)
+        self.assertEqual(report.headerRecords, [2])
+        self.assertEqual(report.expanding, [4])
+        self.assertEqual(report.outOfRange, [3])
+        self.assertEqual(report.index.find(0x103, 0x3FFE01), [
+                         (0x100, 0x104, 0), (0x102, 0x106, 1),
+                         (0x3FFE00, 0x3FFE02, 4)])
+        self.assertFalse(report.valid())
+
+    def testStackedPatchesMatchSequentialApplication(self):
+        """
+        Test that a flattened stack of patches, one of them headered and one
+        of them shrinking the ROM, applies like the patches one after another.
+        """
+        source, target = randomRomData(0x30000, 9)
+        patch = EBPPatch(self.TMP_EBP_FNAME, new=True)
+        patch.createFromSource(BytesIO(source), BytesIO(target[:0x28000]),
+                               METADATA, optimize=True)
+        base = EBPPatch(self.TMP_EBP_FNAME)
+        with open(self.TMP_HACK_FNAME, "wb") as f:
+            f.write(b"PATCH\x00\x03\x00\x00\x03abc"
+                    b"\x02\x81\xF0\x00\x00\x00\x40\x07"
+                    b"\x02\x01\x00\x00\x00\x00\x10z"
+                    b"\x03\x00\x00\x00\x04wxyzEOF")
+        addon = IPSPatch(self.TMP_HACK_FNAME)
+        addon.header = 0x200
+
+        expected = BytesIO(source)
+        base.applyToTarget(expected)
+        addon.applyToTarget(expected)
+        stack = PatchStack([base, addon])
+        self.assertEqual(stack.size, 0x2FE04)
+        flattened = BytesIO(source)
+        stack.flatten().applyToTarget(flattened)
+        self.assertEqual(flattened.getvalue(), expected.getvalue())
+
+        with open(self.TMP_EBP_FNAME, "wb") as f:
+            stack.writePatch(f, stack.mergeMetadata())
+        self.assertEqual(self.applyPatch(source), expected.getvalue())
+        self.assertEqual(EBPPatch(self.TMP_EBP_FNAME).info["title"], "y")
+
+    def testReversiblePatches(self):
+        """
+        Test that a reversible patch can be undone, including the expansion
+        of the ROM, and that a ROM can be switched from one hack to another.
+        """
+        source, target = randomRomData(0x30000, 10)
+        other = randomRomData(0x30000, 11)[1]
+        target += bytes(range(256)) * 0x10
+        patch = EBPPatch(self.TMP_HACK_FNAME, new=True)
+        patch.createFromSource(BytesIO(source), BytesIO(other), METADATA,
+                               reversible=True)
+        patch = EBPPatch(self.TMP_EBP_FNAME, new=True)
+        patch.createFromSource(BytesIO(source), BytesIO(target), METADATA,
+                               optimize=True, reversible=True)
+        patch = EBPPatch(self.TMP_EBP_FNAME)
+        self.assertEqual(self.applyPatch(source), target)
+
+        rom = BytesIO(target)
+        patch.undoPatch().applyToTarget(rom)
+        self.assertEqual(rom.getvalue(), source)
+        rom = BytesIO(target)
+        patch.switchPatch(EBPPatch(self.TMP_HACK_FNAME)).applyToTarget(rom)
+        self.assertEqual(rom.getvalue(), other)
+
+        # A patch shrinking the ROM, and one only adding to its end.
+        for hacked in (source[:0x20000] + b"\x01", source + b"\x01" * 0x10):
+            patch = EBPPatch(self.TMP_EBP_FNAME, new=True)
+            patch.createFromSource(BytesIO(source), BytesIO(hacked), METADATA,
+                                   optimize=True, reversible=True)
+            patch = EBPPatch(self.TMP_EBP_FNAME)
+            self.assertEqual(self.applyPatch(source), hacked)
+            rom = BytesIO(hacked)
+            patch.undoPatch().applyToTarget(rom)
+            self.assertEqual(rom.getvalue(), source)
+
+    def testStreamingApplication(self):
+        """
+        Test that patches applied as they are streamed give the same result
+        as loaded patches, resizing the ROM and skipping its header.
+        """
+        source, target = randomRomData(0x30000, 12)
+        target = target[:0x2C000] + bytes(0x100) + b"\xAA" * 0x40000
+        patch = EBPPatch(self.TMP_EBP_FNAME, new=True)
+        patch.createFromSource(BytesIO(source), BytesIO(target), METADATA,
+                               optimize=True)
+        rom = BytesIO(source)
+        data = open(self.TMP_EBP_FNAME, "rb").read()
+        self.assertGreater(EBPPatch.applyStream(TrickleIO(data), rom), 0)
+        self.assertEqual(rom.getvalue(), target)
+
+        with open(self.TMP_ROM_FNAME, "wb") as f:
+            f.write(bytes(0x200) + source)
+        with open(self.TMP_ROM_FNAME, "r+b") as f:
+            IPSPatch.applyStream(TrickleIO(b"PATCH\x00\x02\x10\x00\x02ab"
+                                           b"EOF\x00\x03\x00"), f, 0x200, 0x200)
+        self.assertEqual(open(self.TMP_ROM_FNAME, "rb").read(),
+                         bytes(0x200) + source[:0x10] + b"ab" +
+                         source[0x12:0x100])
+        with self.assertRaises(ValueError):
+            IPSPatch.applyStream(BytesIO(b"PATCH\x00\x00\x10\x00\x04ab"),
+                                 BytesIO(source))
+
+    def testROMLoadsWithoutCopies(self):
+        """
+        Test that loading a headered, expanded ROM reads its data once, without
+        copying it.
+        """
+        source = addHeader(randomRomData(0x30000, 13)[0] * 0x20)
+        with open(self.TMP_ROM_FNAME, "wb") as f:
+            f.write(source)
+        tracemalloc.start()
+        rom = ROM(self.TMP_ROM_FNAME)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.assertEqual(rom.header, 0x200)
+        self.assertEqual(rom.getvalue(), source[0x200:])
+        self.assertLess(peak, len(source) * 1.2)
+
+    def testFingerprintVariants(self):
+        """
+        Test that the checksums of every variant, computed in one pass, are
+        those of each variant computed on its own.
+        """
+        data = randomRomData(0x30000, 15)[0] * 0x11
+        variants = romVariants(len(data) - 0x10000)
+        variants["short"] = (0x100, {0x10: 1, 0x1000: 2})
+        fingerprints = fingerprintVariants(memoryview(data), variants)
+        self.assertEqual(sorted(fingerprints), sorted(variants))
+        for name, (size, patches) in variants.items():
+            d = bytearray(data[:size])
+            for offset, value in patches.items():
+                if offset < size:
+                    d[offset] = value
+            self.assertEqual(fingerprints[name],
+                             {"crc32": "{:08x}".format(zlib.crc32(d)),
+                              "md5": md5(d).hexdigest(),
+                              "sha1": sha1(d).hexdigest()}, name)
+
+    def testBlockRepair(self):
+        """
+        Test that the blocks in which a dump differs are found, and repaired
+        only if the repair pack has all of them.
+        """
+        clean = randomRomData(0x30000, 16)[0]
+        dump = bytearray(clean)
+        dump[0x1234] ^= 1
+        dump[0x2FFFF] ^= 1
+        writeBlockTable(self.TMP_ROM_FNAME, clean)
+        table = loadBlockTable(self.TMP_ROM_FNAME)
+        blocks = diffBlocks(dump, table)
+        self.assertEqual(blocks, [0x1, 0x2F])
+        self.assertEqual(diffBlocks(dump[:0x2E800], table), [0x1, 0x2E, 0x2F])
+
+        writeRepairPack(self.TMP_HACK_FNAME, clean, [0x1])
+        self.assertFalse(repairBlocks(dump, blocks, table,
+                                      loadRepairPack(self.TMP_HACK_FNAME)))
+        writeRepairPack(self.TMP_HACK_FNAME, clean, [0x1, 0x2F, 0x10])
+        self.assertTrue(repairBlocks(dump, blocks, table,
+                                     loadRepairPack(self.TMP_HACK_FNAME)))
+        self.assertEqual(dump, clean)
+
+    def testBlockRepairOfFiles(self):
+        """
+        Test that a ROM file is normalized with its blocks repaired only if
+        asked to, when it is loaded and when it is read a window at a time,
+        and that patches are only made against a repaired clean ROM.
+        """
+        rng = random.Random(18)
+        clean = bytearray(rng.randbytes(0x300000))
+        clean[0xffc0:0xffc0 + len(ID)] = ID
+        dump = bytearray(clean)
+        dump[0x1234] ^= 1
+        dump[0x2FFFFF] ^= 1
+        with open(self.TMP_ROM_FNAME, "wb") as f:
+            f.write(clean)
+        with open(self.TMP_HACK_FNAME, "wb") as f:
+            f.write(dump)
+
+        paths = BlockDB.BLOCK_TABLE_PATH, BlockDB.REPAIR_PACK_PATH
+        with tempfile.TemporaryDirectory() as root:
+            BlockDB.BLOCK_TABLE_PATH = os.path.join(root, "clean.blocks")
+            BlockDB.REPAIR_PACK_PATH = os.path.join(root, "repair.pack")
+            try:
+                writeBlockTable(BlockDB.BLOCK_TABLE_PATH, clean)
+                writeRepairPack(BlockDB.REPAIR_PACK_PATH, clean, [0x1, 0x2FF])
+                with ROMFile(self.TMP_HACK_FNAME, repair=True) as rom:
+                    self.assertEqual(rom[:], clean)
+                with ROMFile(self.TMP_HACK_FNAME) as rom:
+                    self.assertEqual(rom[:], dump)
+                self.assertEqual(ROM(self.TMP_HACK_FNAME,
+                                     repair=True).getvalue(), clean)
+                rom = ROM(self.TMP_HACK_FNAME)
+                self.assertFalse(rom.clean)
+                self.assertEqual(rom.getvalue(), dump)
+                self.assertEqual(rom.badBlocks, [0x1, 0x2FF])
+
+                # The dump is the hack: its changes are kept in the patch.
+                patch = EBPPatch(self.TMP_EBP_FNAME, new=True)
+                patch.createFromFiles(self.TMP_HACK_FNAME, self.TMP_HACK_FNAME,
+                                      METADATA)
+                checksum = checksumOfFile(self.TMP_EBP_FNAME)
+                patch.createFromSource(ROM(self.TMP_ROM_FNAME),
+                                       ROM(self.TMP_HACK_FNAME), METADATA)
+                self.assertEqual(checksum, checksumOfFile(self.TMP_EBP_FNAME))
+                self.assertEqual(self.applyPatch(clean), dump)
+            finally:
+                BlockDB.BLOCK_TABLE_PATH, BlockDB.REPAIR_PACK_PATH = paths
+
+    def testLazyROM(self):
+        """
+        Test that a lazy ROM rejects files too small to be ROMs without loading
+        them, loads EarthBound ROMs when their data is needed, and identifies
+        known dumps which aren't named "EARTH BOUND" by their checksum.
+        """
+        with open(self.TMP_ROM_FNAME, "wb") as f:
+            f.write(bytes(0x2FFE00))
+        rom = LazyROM(self.TMP_ROM_FNAME)
+        self.assertEqual((rom.header, rom.size), (0, 0x2FFE00))
+        self.assertFalse(rom.valid)
+        self.assertFalse(rom.clean)
+        self.assertIsNone(rom.rom)
+
+        # Make the repaired dump the clean ROM, and its checksum a known one.
+        dump = randomRomData(0x30000, 17)[0] * 0x10
+        repaired = bytearray(dump)
+        repaired[0xffc0:0xffd5] = b"EARTH BOUND          "
+        with open(self.TMP_ROM_FNAME, "wb") as f:
+            f.write(dump)
+        with open(self.TMP_EBP_FNAME, "wb") as f:
+            f.write(b"PATCH\x00\xff\xc0\x00\x15" + repaired[0xffc0:0xffd5] +
+                    b"EOF")
+        module = sys.modules[ROM.__module__]
+        cleanMD5 = module.EB_MD5
+        module.EB_MD5 = md5(repaired).hexdigest()
+        EB_WRONG_MD5[md5(dump).hexdigest()] = self.TMP_EBP_FNAME
+        try:
+            rom = LazyROM(self.TMP_ROM_FNAME)
+            self.assertFalse(rom.isEarthBound())
+            self.assertTrue(rom.valid)
+            self.assertTrue(rom.clean)
+            self.assertEqual(rom.getvalue(), repaired)
+        finally:
+            module.EB_MD5 = cleanMD5
+            del EB_WRONG_MD5[md5(dump).hexdigest()]
+
+        data = addHeader(randomRomData(0x30000, 17)[0] * 0x10)
+        with open(self.TMP_ROM_FNAME, "wb") as f:
+            f.write(data)
+        rom = LazyROM(self.TMP_ROM_FNAME)
+        self.assertEqual((rom.header, rom.size), (0x200, 0x300000))
+        self.assertTrue(rom.isEarthBound())
+        self.assertIsNone(rom.rom)
+        self.assertTrue(rom.valid)
+        self.assertEqual(rom.getvalue(), data[0x200:])
+        self.assertEqual(detectHeader(self.TMP_ROM_FNAME), 0x200)
+
+    def testIdentityCache(self):
+        """
+        Test that a ROM file's verdict is remembered until the file changes or
+        can't be replayed, and that the least recently used files are
+        forgotten.
+        """
+        cachePath = self.TMP_EBP_FNAME + ".sqlite"
+        with open(self.TMP_ROM_FNAME, "wb") as f:
+            f.write(addHeader(randomRomData(0x30000, 14)[0] * 0x10))
+        with open(self.TMP_HACK_FNAME, "wb") as f:
+            f.write(bytes(0x300000))
+        for path in (self.TMP_ROM_FNAME, self.TMP_HACK_FNAME):
+            os.utime(path, (1, 1))
+        ROM.cache = IdentityCache(cachePath, maxEntries=1)
+        try:
+            self.assertFalse(ROM(self.TMP_ROM_FNAME).clean)
+            verdict = ROM.cache.get(self.TMP_ROM_FNAME)
+            self.assertEqual(verdict["header"], 0x200)
+
+            # Make the stored verdict say the ROM is clean, to tell it's used.
+            verdict["clean"] = True
+            ROM.cache.put(self.TMP_ROM_FNAME, verdict)
+            rom = ROM(self.TMP_ROM_FNAME)
+            self.assertTrue(rom.clean)
+            self.assertEqual(len(rom.getvalue()), 0x300000)
+
+            # A verdict whose repair patch can't be found is not trusted.
+            data = rom.getvalue()
+            EB_WRONG_MD5["0" * 32] = "missing.ips"
+            verdict["repair"] = "0" * 32
+            ROM.cache.put(self.TMP_ROM_FNAME, verdict)
+            try:
+                rom = ROM(self.TMP_ROM_FNAME)
+            finally:
+                del EB_WRONG_MD5["0" * 32]
+            self.assertFalse(rom.clean)
+            self.assertEqual(rom.getvalue(), data)
+            verdict = ROM.cache.get(self.TMP_ROM_FNAME)
+            self.assertFalse(verdict["clean"])
+            self.assertIsNone(verdict["repair"])
+
+            # Neither is one made without a repair patch it needed.
+            os.utime(self.TMP_ROM_FNAME, (2, 2))
+            EB_WRONG_MD5[md5(data).hexdigest()] = "missing.ips"
+            try:
+                self.assertFalse(ROM(self.TMP_ROM_FNAME).clean)
+            finally:
+                del EB_WRONG_MD5[md5(data).hexdigest()]
+            self.assertIsNone(ROM.cache.get(self.TMP_ROM_FNAME))
+
+            ROM(self.TMP_HACK_FNAME)
+            self.assertIsNone(ROM.cache.get(self.TMP_ROM_FNAME))
+            with open(self.TMP_HACK_FNAME, "r+b") as f:
+                f.write(b"x")
+            self.assertIsNone(ROM.cache.get(self.TMP_HACK_FNAME))
+        finally:
+            ROM.cache.close()
+            ROM.cache = None
+            for path in (cachePath, cachePath + "-wal", cachePath + "-shm"):
+                if isfile(path):
+                    remove(path)
+
+    def testCompatibilityMatrix(self):
+        """
+        Test that the overlaps between every pair of patches are counted, and
+        that the cached write sets are only recomputed for changed patches.
+        """
+        paths = [self.TMP_EBP_FNAME, self.TMP_HACK_FNAME, self.TMP_ROM_FNAME]
+        cachePath = self.TMP_EBP_FNAME + ".json"
+        for path, records in zip(paths, (
+                b"\x00\x00\x10\x00\x08abcdefgh\x00\x01\x00\x00\x00\x01\x00z",
+                b"\x00\x00\x14\x00\x00\x00\x10\x00\x00\x01\x80\x00\x01x",
+                b"\x00\x00\x40\x00\x01y")):
+            with open(path, "wb") as f:
+                f.write(b"PATCH" + records + b"EOF")
+        try:
+            writeSets = loadWriteSets(paths, cachePath)
+            self.assertEqual(writeSets, [[(0x10, 0x18), (0x100, 0x200)],
+                                         [(0x14, 0x24), (0x180, 0x181)],
+                                         [(0x40, 0x41)]])
+            self.assertEqual(overlapMatrix(writeSets), {(0, 1): 5})
+
+            with open(cachePath) as f:
+                cache = json.load(f)
+            cache[paths[0]]["ranges"] = [[0, 1]]
+            with open(cachePath, "w") as f:
+                json.dump(cache, f)
+            self.assertEqual(loadWriteSets(paths, cachePath)[0], [(0, 1)])
+
+            # Only the IPS patches are headered.
+            with open(paths[2], "ab") as f:
+                f.write(METADATA.encode("utf-8"))
+            self.assertEqual(loadWriteSets(paths, cachePath, 0x200)[1:],
+                             [[(-0x1EC, -0x1DC), (-0x80, -0x7F)],
+                              [(0x40, 0x41)]])
+        finally:
+            remove(cachePath)
                 
 
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(testEbp))
+    suite.addTest(unittest.makeSuite(testDiff))
     return suite
 
 if __name__ == '__main__':